@@ -0,0 +1,54 @@
+import json
+import os
+import resource
+
+# Shared by the benchmarks: summaries, memory use, and comparing a run
+# against a saved baseline.
+
+def percentiles(samples, points=(50, 90, 99)):
+	if not samples:
+		return {f'p{p}': 0 for p in points}
+	ordered = sorted(samples)
+	return {
+		f'p{p}': ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+		for p in points
+	}
+
+# Resident memory in bytes, or the peak where the current isn't available
+def rss():
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except OSError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def format_value(name, value):
+	if name.endswith('_s'):
+		return f'{value * 1000:10.3f} ms'
+	if name.endswith('_bytes'):
+		return f'{value / 1024:10.1f} KiB'
+	if isinstance(value, float):
+		return f'{value:10.2f}'
+	return f'{value:10}'
+
+# Prints results, a flat {name: number} map, next to a baseline if given.
+# Names ending in _s are seconds and _bytes are bytes.
+def report(results, baseline=None):
+	width = max(map(len, results), default=0)
+	for name, value in results.items():
+		line = f'{name:<{width}} {format_value(name, value)}'
+		old = baseline.get(name) if baseline else None
+		if old:
+			line += f'  {(value - old) / old * 100:+7.1f}%'
+		print(line)
+
+def load_baseline(fileName):
+	if not fileName:
+		return None
+	with open(fileName) as f:
+		return json.load(f)
+
+def save_results(fileName, results):
+	if fileName:
+		with open(fileName, 'w') as f:
+			json.dump(results, f, indent='\t')
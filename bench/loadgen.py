@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import random
+import time
+from bench.common import percentiles, rss, report, load_baseline, save_results
+
+# Simulated players. Each connects over a websocket, speaking packets_json
+# (or packets_bin), walks in circles, eats and speaks letters and now and
+# then plants something. Run from the repository root:
+#
+#   python -m bench.loadgen --clients 100              against a server started here
+#   python -m bench.loadgen --url ws://host:2822/connect  against a running server
+#
+# With a local server, tick durations and server memory are reported too.
+# Clients run in a separate process so they don't slow the server down.
+
+async def run_client(url, index, codec, args, stats, stop_at):
+	import websockets
+	from server.clients import codecs
+	packets = codecs[codec]
+
+	face = f'L{index:04}'[-5:]
+	async with websockets.connect(f'{url}?codec={codec}', max_size=None) as ws:
+		await ws.send(face)
+		reply = await ws.recv()
+		if not reply.startswith('success:'):
+			stats['failed'] += 1
+			return
+		stats['connected'] += 1
+
+		async def receive():
+			while True:
+				message = await ws.recv()
+				stats['messages'] += 1
+				stats['received_bytes'] += len(message)
+
+		receiving = asyncio.ensure_future(receive())
+		x = random.uniform(-500, 500)
+		y = random.uniform(-500, 500)
+		angle = random.uniform(0, math.tau)
+		interval = 1 / args.rate
+		sent = 0
+		try:
+			while time.monotonic() < stop_at:
+				angle += 0.05
+				x += math.cos(angle) * 5
+				y += math.sin(angle) * 5
+				fields = {'pos': [x, y], 'rot': angle}
+				if sent % args.speak_every == 0:
+					char = random.choice('abcdefghijklmnopqrstuvwxyz')
+					fields['speech'] = ''
+					fields['textActs'] = [
+						{'type': 'eat', 'char': char},
+						{'type': 'speak', 'char': char},
+					]
+				await ws.send(packets.C_UpdateSelf(**fields))
+				if args.plant_every and sent % args.plant_every == args.plant_every - 1:
+					await ws.send(packets.C_MakePlant(pos=[x, y], rot=0, text='plant'))
+				sent += 1
+				stats['sent'] += 1
+				await asyncio.sleep(interval)
+		finally:
+			receiving.cancel()
+
+async def run_clients(url, args):
+	stats = dict.fromkeys(
+		['connected', 'failed', 'sent', 'messages', 'received_bytes'], 0)
+	start = time.monotonic()
+	stop_at = start + args.seconds
+	tasks = []
+	for i in range(args.clients):
+		codec = args.codec
+		if codec == 'mixed':
+			codec = 'bin' if i % 2 else 'json'
+		tasks.append(asyncio.ensure_future(
+			run_client(url, i, codec, args, stats, stop_at)))
+		# Don't connect everyone in the same instant
+		await asyncio.sleep(args.ramp / args.clients)
+	results = await asyncio.gather(*tasks, return_exceptions=True)
+	stats['errors'] = sum(isinstance(r, Exception) for r in results)
+	stats['seconds'] = time.monotonic() - start
+	return stats
+
+def client_process(url, args, conn):
+	conn.send(asyncio.run(run_clients(url, args)))
+
+async def serve(universe):
+	import websockets
+	from urllib.parse import parse_qs, urlsplit
+	from websockets.exceptions import ConnectionClosed
+	from server.clients import WSClient, codecs
+
+	# The same handshake as the /connect route
+	async def on_connect(ws, path):
+		query = parse_qs(urlsplit(path).query)
+		codec = codecs.get(query.get('codec', ['json'])[0])
+		face = await ws.recv()
+		client = WSClient(ws, face, codec)
+		client.log = lambda *args: None
+		try:
+			async with universe.add_client(client) as client:
+				await client.run()
+		except (ConnectionClosed, KeyError, RuntimeError):
+			pass
+
+	return await websockets.serve(on_connect, '127.0.0.1', 0, max_size=None)
+
+async def main():
+	parser = argparse.ArgumentParser(description='Load a server with simulated clients')
+	parser.add_argument('--clients', type=int, default=50)
+	parser.add_argument('--seconds', type=float, default=20)
+	parser.add_argument('--ramp', type=float, default=2, help='seconds to connect everyone over')
+	parser.add_argument('--rate', type=float, default=20, help='updates per client per second')
+	parser.add_argument('--speak-every', type=int, default=10, help='updates between text acts')
+	parser.add_argument('--plant-every', type=int, default=200, help='updates between plants, 0 for none')
+	parser.add_argument('--codec', choices=['json', 'bin', 'mixed'], default='json')
+	parser.add_argument('--url', help='websocket URL of a running server')
+	parser.add_argument('--json', help='save the results to this file')
+	parser.add_argument('--baseline', help='compare with results saved by --json')
+	args = parser.parse_args()
+	json_file = args.json and os.path.abspath(args.json)
+	baseline = load_baseline(args.baseline)
+
+	conn, child_conn = multiprocessing.Pipe()
+	results = {}
+	if args.url:
+		process = multiprocessing.Process(
+			target=client_process, args=(args.url, args, child_conn))
+		process.start()
+		stats = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+	else:
+		from server.world import ChatterUniverse
+		universe = ChatterUniverse()
+		server = await serve(universe)
+		port = server.sockets[0].getsockname()[1]
+
+		durations = []
+		tick = universe.scheduler.tick
+		def timed_tick(world):
+			tick(world)
+			durations.append(world.tick_duration)
+		universe.scheduler.tick = timed_tick
+
+		ticking = asyncio.ensure_future(universe.run())
+		memory = rss()
+		process = multiprocessing.Process(
+			target=client_process,
+			args=(f'ws://127.0.0.1:{port}/connect', args, child_conn))
+		process.start()
+		stats = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+
+		world = universe.default
+		for name, value in percentiles(durations).items():
+			results[f'tick_{name}_s'] = value
+		results['tick_max_s'] = max(durations, default=0)
+		results['ticks'] = len(durations)
+		results['tick_overruns'] = world.tick_overruns
+		results['skipped_ticks'] = world.skipped_ticks
+		results['entities'] = len(world.entities)
+		results['server_memory_growth_bytes'] = rss() - memory
+
+		ticking.cancel()
+		server.close()
+		await server.wait_closed()
+	process.join()
+
+	connected = max(stats['connected'], 1)
+	results['clients_connected'] = stats['connected']
+	results['clients_failed'] = stats['failed'] + stats['errors']
+	results['received_per_client_per_second_bytes'] = (
+		stats['received_bytes'] / connected / stats['seconds'])
+	results['messages_per_client_per_second'] = (
+		stats['messages'] / connected / stats['seconds'])
+	results['sent_per_client_per_second'] = stats['sent'] / connected / stats['seconds']
+
+	report(results, baseline)
+	save_results(json_file, results)
+
+if __name__ == '__main__':
+	asyncio.run(main())
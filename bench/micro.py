@@ -0,0 +1,136 @@
+import argparse
+import os
+import random
+import time
+from bench.common import percentiles, rss, report, load_baseline, save_results
+
+# In-process microbenchmarks. Run from the repository root:
+#
+#   python -m bench.micro                       print the results
+#   python -m bench.micro --json base.json      ...and save them
+#   python -m bench.micro --baseline base.json  ...next to an earlier run
+
+def timed(fn, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		fn()
+	return (time.perf_counter() - start) / repeat
+
+def bench_tick(results, clients, plants, ticks):
+	from server.world import ChatterWorld
+	from server.clients import WSClient, NullSocket, codecs
+	from server.entity import Point
+	from server.plant import Plant
+	from server import markov
+
+	# Load the corpus up front, rather than growing from the fallback
+	markov.get_corpus()
+	world = ChatterWorld('bench', growth_rate=0)
+	for i in range(plants):
+		world.add_entity(Plant(Point(random.uniform(-1500, 1500), random.uniform(-1500, 1500)), 0))
+	# Grow the plants before measuring
+	world.growth.rate = 5
+	for _ in range(600):
+		world.broadcast_tick()
+	world.growth.rate = 0
+
+	for i in range(clients):
+		codec = codecs['bin' if i % 2 else 'json']
+		world.add_client(WSClient(NullSocket(), f'b{i:04}', codec))
+
+	memory = rss()
+	durations = []
+	ants = [client.entity for client in world.clients.values()]
+	for tick in range(ticks):
+		for i, ant in enumerate(ants):
+			angle = (tick + i * 10) / 30
+			ant.pos = Point(400 * random.random() + 300 * (angle % 1), 300 * (angle % 2))
+			ant.rot = angle
+		start = time.perf_counter()
+		world.broadcast_tick()
+		durations.append(time.perf_counter() - start)
+		# As if every client kept up
+		for client in world.clients.values():
+			while client.queue:
+				client.pop_packet()
+
+	for name, value in percentiles(durations).items():
+		results[f'tick_{name}_s'] = value
+	results['tick_entities'] = len(world.entities)
+	results['tick_memory_growth_bytes'] = rss() - memory
+
+def bench_markov(results):
+	from server import markov
+
+	fileName = markov.corpora[markov.DEFAULT_CORPUS]
+	start = time.perf_counter()
+	source = markov.MarkovSource()
+	source.load(fileName)
+	results['markov_load_s'] = time.perf_counter() - start
+
+	words = source.tokens[1:200]
+	results['markov_chain_s'] = timed(
+		lambda: source.chain(random.choice(words), random.choice(words)), 10000)
+
+	import numpy as np
+	rng = np.random.default_rng()
+	pairs = [(random.choice(words), random.choice(words)) for _ in range(1000)]
+	results['markov_chain_many_1000_s'] = timed(lambda: source.chain_many(pairs, rng), 20)
+
+def bench_packets(results, entities):
+	from server.clients import codecs
+	from server.entity import Point
+	from server.box import Box
+
+	boxes = []
+	for i in range(entities):
+		box = Box(Point(random.uniform(0, 1000), random.uniform(0, 1000)), random.random(), 'box')
+		box.handle = i
+		box.id = f'#{i:05x}'
+		boxes.append(box)
+
+	for name, packets in codecs.items():
+		def encode():
+			cache = packets.FragmentCache()
+			packets.S_UpdateWorld.splice(entities=[
+				cache.entry(box, 'data', box.data) for box in boxes])
+		results[f'{name}_update_{entities}_s'] = timed(encode, 100)
+
+		cache = packets.FragmentCache()
+		update = packets.S_UpdateWorld.splice(entities=[
+			cache.entry(box, 'data', box.data) for box in boxes])
+		results[f'{name}_update_{entities}_bytes'] = len(update)
+
+		packet = packets.C_UpdateSelf(
+			pos=[120.5, -33.25], rot=1.5,
+			textActs=[{'type': 'eat', 'char': 'a'}, {'type': 'speak', 'char': 'a'}])
+		results[f'{name}_update_self_encode_s'] = timed(lambda: packets.C_UpdateSelf(
+			pos=[120.5, -33.25], rot=1.5,
+			textActs=[{'type': 'eat', 'char': 'a'}, {'type': 'speak', 'char': 'a'}]), 10000)
+		results[f'{name}_update_self_decode_s'] = timed(lambda: packets.unpack(None, packet), 10000)
+
+def main():
+	parser = argparse.ArgumentParser(description='Run the microbenchmarks')
+	parser.add_argument('--clients', type=int, default=50)
+	parser.add_argument('--plants', type=int, default=100)
+	parser.add_argument('--ticks', type=int, default=300)
+	parser.add_argument('--entities', type=int, default=200, help='entities per encoded update')
+	parser.add_argument('--json', help='save the results to this file')
+	parser.add_argument('--baseline', help='compare with results saved by --json')
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+	# Importing the server changes directory
+	json_file = args.json and os.path.abspath(args.json)
+	baseline = load_baseline(args.baseline)
+
+	random.seed(args.seed)
+	results = {}
+	bench_packets(results, args.entities)
+	bench_markov(results)
+	bench_tick(results, args.clients, args.plants, args.ticks)
+
+	report(results, baseline)
+	save_results(json_file, results)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import time
+from server.world import ChatterUniverse
+from server.clients import WSClient, NullSocket
+from server.journal import read_journal
+from server.persistence import build_entity, restore_entities
+from server.entity import dirty_bit
+import server.packets_json as packets_json
+
+# Replays a journal written with run.py's journal_dir, without a browser.
+#
+#   python replay.py JOURNAL                  rebuild the worlds as fast as possible
+#   python replay.py JOURNAL --saves saves    start from the saved worlds, replaying
+#                                             only what happened since each was saved
+#   python replay.py JOURNAL --realtime       re-run the session at its recorded pace,
+#                                             with plants growing live
+#   python replay.py JOURNAL --saves saves --save
+#                                             save the rebuilt worlds back there
+
+class Replay:
+	def __init__(self, universe, realtime=False):
+		self.universe = universe
+		self.realtime = realtime
+		self.clients = {}
+		# Journaled ticks are offset from a restored world's, which start at 0
+		self.tick_offsets = {}
+		self.events = 0
+
+	def world(self, world_id):
+		world = self.universe.worlds.get(world_id)
+		if world is None:
+			# Growth comes from the journal, unless replaying live
+			kwargs = {} if self.realtime else {'growth_rate': 0}
+			world = self.universe.new_world(world_id, **kwargs)
+			self.universe.add_world(world)
+		elif world.hibernating:
+			self.universe.wake(world)
+		return world
+
+	def add_client(self, world, face, handle=None):
+		client = self.clients[face] = WSClient(NullSocket(), face, packets_json)
+		# Only what was let through was journaled
+		client.limited = False
+		world.add_client(client, handle)
+		if self.realtime:
+			client.start_writer()
+
+	def apply(self, record):
+		_, world_id, tick, event, face, fields = record
+		world = self.world(world_id)
+		if world_id not in self.tick_offsets:
+			self.tick_offsets[world_id] = tick - world.tick
+
+		if not self.realtime:
+			# Step the world to the tick the event happened in
+			tick -= self.tick_offsets[world_id]
+			while world.tick < tick:
+				world.broadcast_tick()
+				# Nobody is listening, but updates are only diffs once received
+				for client in world.clients.values():
+					while client.queue:
+						client.pop_packet()
+
+		self.events += 1
+		if event == 'opened':
+			# In place of the world's own random terrain
+			restore_entities(world, {
+				handle: (data, links) for handle, data, links in fields['entities']
+			}, fields['next_handle'])
+		elif event == 'join':
+			self.add_client(world, face)
+		elif event == 'leave':
+			client = self.clients.pop(face, None)
+			if client and client.world:
+				client.world.remove_client(client)
+			if client:
+				client.stop_writer()
+		elif event == 'grow':
+			if not self.realtime:
+				word = build_entity(fields['data'], fields['links'], world.static_entities)
+				world.add_entity(word, fields['handle'])
+		elif event == 'changed':
+			if not self.realtime:
+				entity = world.static_entities.get(fields['handle'])
+				if entity:
+					for name, value in fields['diff'].items():
+						entity.data[name] = value
+						entity.mark_dirty(dirty_bit(name))
+		elif event == 'saved':
+			# Ants aren't saved, so bring back whoever was connected
+			for client_face, handle in fields['clients'].items():
+				if client_face not in self.clients:
+					self.add_client(world, client_face, handle)
+		else:
+			client = self.clients.get(face)
+			if client and client.world:
+				client.handle(packets_json.Packet(packets_json.types[event], **fields))
+
+	async def run(self, records):
+		start = time.monotonic()
+		if self.realtime:
+			ticking = asyncio.ensure_future(self.universe.run())
+
+		for record in records:
+			if self.realtime:
+				delay = start + record[0] / 1000 - time.monotonic()
+				if delay > 0:
+					await asyncio.sleep(delay)
+			self.apply(record)
+
+		if self.realtime:
+			ticking.cancel()
+		return time.monotonic() - start
+
+# Each world only needs replaying from its last save
+def since_saves(records):
+	saves = {}
+	for i, record in enumerate(records):
+		if record[3] == 'saved':
+			saves.setdefault(record[1], []).append(i)
+		elif record[3] == 'save_failed':
+			saves[record[1]].pop()
+	last_save = {world_id: s[-1] for world_id, s in saves.items() if s}
+	return [
+		record for i, record in enumerate(records)
+		if i >= last_save.get(record[1], -1)
+	]
+
+async def main():
+	parser = argparse.ArgumentParser(description='Replay a world journal')
+	parser.add_argument('journal')
+	parser.add_argument('--saves', help='directory of saved worlds to start from')
+	parser.add_argument('--realtime', action='store_true')
+	parser.add_argument('--save', action='store_true', help='save the worlds back to --saves afterwards')
+	args = parser.parse_args()
+
+	universe = ChatterUniverse(default_world=False)
+	replay = Replay(universe, args.realtime)
+	records = list(read_journal(args.journal))
+	if args.saves:
+		universe.enable_saving(args.saves)
+		# Worlds with nothing to replay still get restored
+		for world_id in {record[1] for record in records}:
+			replay.world(world_id)
+		records = since_saves(records)
+
+	duration = await replay.run(records)
+
+	print(f'Replayed {replay.events} events in {duration:.3f}s')
+	for world in universe.worlds.values():
+		print(f'  {world.id}: {len(world.entities)} entities, '
+			f'{len(world.plants)} plants, tick {world.tick}')
+
+	if args.save and universe.store:
+		await universe.close()
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -1,7 +1,24 @@
-from server import app
+import os
+from server import app, universe
 
 port = 2822 # 0xB06
 ipv6 = False
+workers = 0 # Extra processes to host worlds in
+save_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saves') # None to not save worlds
+journal_dir = None # Where to journal changes to worlds, for replay.py
+metrics = False # Time ticks and count packets, for /metrics
+
+if save_dir:
+	universe.enable_saving(save_dir)
+
+if journal_dir:
+	universe.enable_journal(journal_dir)
+
+if metrics:
+	universe.enable_metrics()
+
+if workers:
+	universe.start_workers(workers)
 
 if ipv6:
 	import socket
@@ -1,11 +1,17 @@
 import os
 import asyncio
-from sanic import Sanic
-from server.clients import WSClient
+from sanic import Sanic, response
+from server.clients import WSClient, codecs
 from server.world import ChatterUniverse, ChatterWorld
+from server.sharding import RemoteWorld
+from server.metrics import metrics
+from server.limits import is_face
 
 app = Sanic()
 
+# Seconds a new connection has to send its face
+handshake_timeout = 10
+
 universe = ChatterUniverse()
 app.add_task(universe.run())
 
@@ -14,15 +20,55 @@ app.static('/js', './static/js', content_type='application/javascript')
 app.static('/img', './static/img')
 app.static('/', './static/html/index.html')
 
+@app.listener('before_server_stop')
+async def save_worlds(app, loop):
+	await universe.close()
+
+# Timings and packet counts are only there after universe.enable_metrics()
+@app.route('/metrics')
+async def prometheus_metrics(request):
+	return response.text(metrics.prometheus(universe),
+		content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/metrics.json')
+async def json_metrics(request):
+	return response.json(metrics.snapshot(universe))
+
 @app.websocket('/connect')
 async def client_connect(request, ws):
-	face = await ws.recv()
+	try:
+		face = await asyncio.wait_for(ws.recv(), handshake_timeout)
+	except asyncio.TimeoutError:
+		return
 	
 	print('Receive connection:', face)
 	
-	client = WSClient(ws, face)
-	async with universe.add_client(client):
-		await client.run()
+	if not is_face(face):
+		await ws.send('invalid_face')
+		return
+	
+	codec = request.args.get('codec', 'json')
+	if codec not in codecs:
+		await ws.send('invalid_codec')
+		return
+	
+	# Worlds are made as they're first asked for
+	world = universe.open_world(request.args.get('world', 'default'))
+	if world is None:
+		await ws.send('invalid_world')
+		return
+	
+	# Given when reconnecting, with how many world updates were received
+	session = request.args.get('session')
+	received = request.args.get('received')
+	received = int(received) if received and received.isdigit() else None
+	
+	client = WSClient(ws, face, codecs[codec])
+	async with universe.add_client(client, world, session, received) as client:
+		if isinstance(world, RemoteWorld):
+			await world.worker.proxy(client, world.id, codec, session, received)
+		else:
+			await client.run()
 	
 	if client.ws.open:
 		print('Client exited without closing socket!')
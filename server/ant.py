@@ -1,90 +1,225 @@
-from server.entity import Point, EntityBase, dataprop
+from server.entity import Point, EntityBase, dataprop, dirty_bit
+from server.limits import is_char, is_number, is_pos, is_text
 
-class CounterNetProp:
-	def __init__(self, entity, name):
-		self.entity = entity
-		self.name = name
+SPEECH = dirty_bit('speech')
+TEXT_ACTS = dirty_bit('textActs')
+
+# What an ant is saying, as a list of parts: lists of letters (and spaces)
+# spoken one at a time, and untracked text, like 'BOX:', that wasn't spoken
+# from the gut. Speaking and unspeaking only touch the last part; the text
+# is only joined into a string when it's sent. Untracked text is wrapped in
+# '\0's in the string.
+class Speech:
+	__slots__ = ('parts', 'length', '_text')
 	
-	@property
-	def data(self):
-		return self.entity.data.setdefault(self.name, {})
+	def __init__(self, text=''):
+		self.parts = []
+		self.length = 0
+		self._text = None
+		untracked = False
+		for chunk in text.split('\0'):
+			if untracked:
+				self.add_untracked(chunk)
+			else:
+				for char in chunk:
+					self.add_char(char)
+			untracked = not untracked
 	
 	@property
-	def diff(self):
-		return self.entity.diff.setdefault(self.name, {})
+	def text(self):
+		if self._text is None:
+			self._text = ''.join(
+				''.join(part) if isinstance(part, list) else f'\0{part}\0'
+				for part in self.parts)
+		return self._text
 	
-	def __setitem__(self, key, count):
-		if count > 0:
-			self.data[key] = count
-			self.diff[key] = count
+	def add_char(self, char):
+		if self.parts and isinstance(self.parts[-1], list):
+			self.parts[-1].append(char)
 		else:
-			del self.data[key]
-			self.diff[key] = 0
+			self.parts.append([char])
+		self.length += 1
+		self._text = None
 	
-	def __getitem__(self, key):
-		return self.data.get(key, 0)
+	def add_untracked(self, text):
+		self.parts.append(text)
+		self.length += len(text) + 2
+		self._text = None
 	
-	def __delitem__(self, key):
-		del self.data[key]
-		self.diff[key] = 0
+	# Removes the last letter or untracked text, returning the letter
+	def pop(self):
+		if not self.parts:
+			raise ValueError('Nothing to unspeak')
+		part = self.parts[-1]
+		self._text = None
+		if isinstance(part, list):
+			char = part.pop()
+			if not part:
+				self.parts.pop()
+			self.length -= 1
+			return char
+		self.parts.pop()
+		self.length -= len(part) + 2
+		return None
+	
+	# Letters spoken from the gut
+	def letters(self):
+		for part in self.parts:
+			if isinstance(part, list):
+				for char in part:
+					if char != ' ':
+						yield char
 
 class Ant(EntityBase):
+	__slots__ = ('client', 'correcting', 'gut', 'gut_changed', 'speech_buffer',
+		'speech_diff', 'text_acts')
 	type_id = 'ant'
+	radius = 40
+	# Longest speech, and untracked text in it
+	max_speech = 200
+	max_untracked = 16
+	# Text acts sent to other clients per tick. Past this, they're sent the
+	# ant's speech and gut instead.
+	max_text_act_diff = 16
 	
 	def __init__(self, client, pos, angle=0):
 		super().__init__(pos, angle, id=client.face,)
 		self.client = client
 		self.correcting = False
+		self.text_acts = None
 		
+		# Letter counts, and the letters whose counts changed this tick
+		self.gut = {}
+		self.gut_changed = set()
+		self.data['gut'] = {}
 		self.speech = None
-		self.gut = CounterNetProp(self, 'gut')
 	
-	speech = dataprop('speech')
+	@property
+	def speech(self):
+		return None if self.speech_buffer is None else self.speech_buffer.text
+	
+	@speech.setter
+	def speech(self, value):
+		self.speech_buffer = None if value is None else Speech(value)
+		# Text acts later in the tick are applied on top of this value, so
+		# the diff keeps it rather than reading the speech back
+		self.speech_diff = value
+		self.mark_dirty(SPEECH)
+	
 	bell_type = dataprop('bellType')
 	
+	# Speech and gut change many times a tick, so data is only brought up to
+	# date once, before the ant is sent
+	def sync_data(self):
+		self.data['speech'] = self.speech
+		if self.gut_changed:
+			self.data['gut'] = dict(self.gut)
+	
+	@property
+	def diff(self):
+		diff = super().diff
+		acts = diff.get('textActs')
+		if acts is not None and len(acts) > self.max_text_act_diff:
+			del diff['textActs']
+			diff['speech'] = self.speech
+			diff['gut'] = {char: self.gut.get(char, 0) for char in self.gut_changed}
+		return diff
+	
+	def diff_value(self, name):
+		if name == 'speech':
+			return self.speech_diff
+		elif name == 'gut':
+			return {char: self.gut.get(char, 0) for char in self.gut_changed}
+		elif name == 'textActs':
+			return self.text_acts
+		return super().diff_value(name)
+	
+	def clear_diff(self):
+		super().clear_diff()
+		self.gut_changed = set()
+		self.text_acts = None
+	
+	def add_to_gut(self, char, count):
+		count += self.gut.get(char, 0)
+		if count > 0:
+			self.gut[char] = count
+		else:
+			self.gut.pop(char, None)
+		self.gut_changed.add(char)
+	
 	def add_text_act(self, act):
 		t = act['type']
-		gut = self.data.setdefault('gut', {})
+		speech = self.speech_buffer
 		
 		if t == 'eat':
 			char = act['char']
-			gut[char] = gut.get(char, 0) + 1
+			if not is_char(char):
+				raise ValueError(f'Invalid char {char!r}')
+			self.add_to_gut(char, 1)
+			# Where the letter was eaten from, for the animation
+			pos = act.get('pos')
+			rot = act.get('rot')
+			act = {'type': t, 'char': char}
+			if is_pos(pos) and is_number(rot):
+				act['pos'] = pos
+				act['rot'] = rot
 		elif t == 'speak':
 			char = act['char']
-			gut[char] -= 1
-			if gut[char] <= 0:
-				del gut[char]
-			self.data['speech'] = self.data['speech'] + char
+			if self.gut.get(char, 0) <= 0:
+				raise ValueError(f'No {char!r} to speak')
+			self.check_room(speech, 1)
+			speech.add_char(char)
+			self.add_to_gut(char, -1)
+			act = {'type': t, 'char': char}
 		elif t == 'untracked':
 			text = act['text']
-			if text not in ' ':
-				text = f'\0{text}\0'
-			self.data['speech'] = self.data['speech'] + text
-		elif t == 'unspeak':
-			speech = self.data['speech']
-			if speech[-1] == '\0':
-				self.data['speech'] = speech[:speech.rfind('\0', 0, -1)]
+			if not text or not is_text(text, self.max_untracked):
+				raise ValueError('Invalid untracked text')
+			if text in ' ':
+				self.check_room(speech, len(text))
+				for char in text:
+					speech.add_char(char)
 			else:
-				self.data['speech'] = speech[:-1]
-				if speech[-1] != ' ':
-					char = speech[-1]
-					gut[char] = gut.get(char, 0) + 1
+				self.check_room(speech, len(text) + 2)
+				speech.add_untracked(text)
+			act = {'type': t, 'text': text}
+		elif t == 'unspeak':
+			if speech is None:
+				raise ValueError('Not speaking')
+			char = speech.pop()
+			if char is not None and char != ' ':
+				self.add_to_gut(char, 1)
+			# Undoes the act before it, if that added to the speech
+			if self.text_acts and self.text_acts[-1]['type'] in ('speak', 'untracked'):
+				self.text_acts.pop()
+				self.mark_dirty(TEXT_ACTS)
+				return
+			act = {'type': t}
 		elif t == 'clear':
-			untracked = False
-			for chunk in self.data['speech'].split('\0'):
-				if untracked:
-					continue
-				
-				for char in chunk:
-					if char == ' ':
-						continue
-					gut[char] = gut.get(char, 0) + 1
-				
-				untracked = not untracked
-			self.data['speech'] = None
+			if speech is None:
+				raise ValueError('Not speaking')
+			for char in speech.letters():
+				self.add_to_gut(char, 1)
+			self.speech_buffer = None
+			# Whatever was said or unsaid this tick ends up back in the gut
+			# either way
+			while self.text_acts and self.text_acts[-1]['type'] in (
+					'speak', 'untracked', 'unspeak'):
+				self.text_acts.pop()
+			act = {'type': t}
 		elif t == 'destroy':
-			self.data['speech'] = None
+			self.speech_buffer = None
+			act = {'type': t}
 		else:
 			raise ValueError(f'Invalid text act type {t}')
 		
-		self.diff.setdefault('textActs', []).append(act)
+		if self.text_acts is None:
+			self.text_acts = []
+		self.text_acts.append(act)
+		self.mark_dirty(TEXT_ACTS)
+	
+	def check_room(self, speech, length):
+		if speech is None:
+			raise ValueError('Not speaking')
+		if speech.length + length > self.max_speech:
+			raise ValueError('Speech too long')
@@ -1,11 +1,15 @@
 from server.entity import Point, EntityBase, dataprop
 
 class Box(EntityBase):
+	__slots__ = ()
 	type_id = 'box'
 	
 	def __init__(self, pos, angle=0, text=''):
-		super().__init__(pos, angle)
+		super().__init__(pos, angle, static=True)
 		
 		self.text = text
 	
 	text = dataprop('text')
+	
+	def get_obb(self):
+		return (self.pos, self.rot, 50, 50)
@@ -1,31 +1,316 @@
 import asyncio
-import server.packets_json as packets
+import math
+import time
+from collections import deque
+import server.packets_json as packets_json
+import server.packets_bin as packets_bin
 from websockets.exceptions import ConnectionClosed
 from server.entity import Point
+from server.ant import Ant
 from server.box import Box
 from server.plant import Plant
+from server.terrblock import TerrBlock
+from server.spatial import aabb_sqr_distance
+from server.limits import TokenBucket, is_number, is_pos, is_text
+from server import markov
+from server.metrics import metrics
+
+codecs = {
+	'json': packets_json,
+	'bin': packets_bin,
+}
+
+# Stands in for a websocket for clients with nobody on the other end, as in
+# replays and benchmarks
+class NullSocket:
+	open = True
+	
+	async def send(self, data):
+		pass
+	
+	async def recv(self):
+		await asyncio.Future()
+	
+	async def close(self, reason=''):
+		self.open = False
 
 class WSClient:
-	def __init__(self, ws, face):
+	view_radius = 1000
+	# What a client can see is worked out again each time its ant crosses
+	# into another cell of this size
+	view_step = 256
+	# Bytes that may be waiting to be sent before the overflow policy kicks in
+	max_buffer = 4 * 1024 * 1024
+	# 'disconnect' closes the client, 'drop' drops world updates (which are
+	# resent as full snapshots later) and only disconnects for other packets
+	overflow_policy = 'disconnect'
+	# Bytes of entities sent per tick while catching up after joining
+	join_batch_bytes = 32 * 1024
+	# World updates remembered so they can be taken back if a client resumes
+	# its session without having received them
+	resume_history = 60
+	
+	# Packets of each type a client may send per second, and in a burst.
+	# Other packets are refused.
+	packet_rates = {
+		'C_UpdateSelf': (60, 60),
+		'C_MakeBox': (0.5, 5),
+		'C_MakePlant': (0.2, 3),
+		'C_Destroy': (10, 20),
+	}
+	# Fastest an ant may move, in units per second, give or take move_slack
+	# for network jitter. Faster moves are cut short and corrected.
+	max_speed = 250
+	move_slack = 50
+	# How far from its ant a client may make or destroy things
+	max_reach = 300
+	max_text_acts = 32
+	max_text = 100
+	
+	def __init__(self, ws, face, packets=packets_json):
 		self.face = face
 		self.ws = ws
+		self.packets = packets
 		self.world = None
 		self.entity = None
+		# The movement of each moving entity the client has, as of the last
+		# world update it received
+		self.sent_movement = {}
+		# The tick up to which the client has been sent each entity it has,
+		# as of the last world update that went out
+		self.sent = {}
+		# Whether the client has been sent everything it can see since joining
+		self.ready = False
+		# The ant's cell and the box the client can see from it (see
+		# ChatterWorld.update_view), the static entities in that box, and the
+		# moving ones that were in it last tick
+		self.view_cell = None
+		self.view = None
+		self.visible = set()
+		self.visible_moving = set()
+		# Entities to check the client is up to date with, since an update
+		# about them was lost or they came into or went out of view
+		self.stale = set()
+		
+		# Clients with a session stay in their world for a while after
+		# disconnecting, so they can pick up where they left off
+		self.session = None
+		self.suspended = False
+		self.expiry = None
+		# World updates sent since the last S_OpenWorld, and the sent ticks
+		# and movement the latest of them replaced
+		self.updates_sent = 0
+		self.acknowledged = deque(maxlen=self.resume_history)
+		
+		# Outbound queue of (packet, update), where update is what a world
+		# update brings the client up to date with (see acknowledge), or None
+		# for other packets
+		self.queue = deque()
+		self.queue_ready = asyncio.Event()
+		self.queued_bytes = 0
+		self.writer = None
+		self.overflowed = False
+		
+		self.max_queue_depth = 0
+		self.frames_sent = 0
+		self.frames_coalesced = 0
+		self.frames_dropped = 0
+		
+		# Replays turn this off, since they only contain what was let through
+		self.limited = True
+		self.buckets = {}
+		self.moved_at = 0
+		# Packets, or the parts of them, refused by reason
+		self.rejected = {}
 	
 	def __hash__(self):
 		return hash(self.face)
 	
+	@property
+	def queue_depth(self):
+		return len(self.queue)
+	
+	# Send directly, bypassing the queue. Only for the handshake.
 	async def send(self, packet):
 		try:
 			return await self.ws.send(packet)
 		except ConnectionClosed:
 			pass
 	
+	def start_writer(self):
+		if not self.writer:
+			self.writer = asyncio.ensure_future(self.write_loop())
+	
+	def stop_writer(self):
+		if self.writer:
+			self.writer.cancel()
+			self.writer = None
+	
+	async def write_loop(self):
+		while True:
+			while not self.queue:
+				self.queue_ready.clear()
+				await self.queue_ready.wait()
+			
+			packet = self.pop_packet()
+			
+			try:
+				await self.ws.send(packet)
+			except ConnectionClosed:
+				break
+			self.frames_sent += 1
+	
+	# Takes the next packet to send off the queue. A world update counts as
+	# received from here on.
+	def pop_packet(self):
+		packet, update = self.queue.popleft()
+		self.queued_bytes -= len(packet)
+		if update is not None:
+			self.updates_sent += 1
+			if self.session is not None:
+				tick, entities, removed, moved = update
+				sent = self.sent
+				sent_movement = self.sent_movement
+				self.acknowledged.append([
+					(e, sent.get(e), sent_movement.get(e))
+					for e in {*entities, *removed, *moved}
+				])
+			self.acknowledge(*update)
+		return packet
+	
+	# entities were sent up to tick, removed were removed, and moved holds the
+	# movement that was sent, by entity
+	def acknowledge(self, tick, entities, removed, moved):
+		sent = self.sent
+		for entity in entities:
+			sent[entity] = tick
+		for entity in removed:
+			sent.pop(entity, None)
+			self.sent_movement.pop(entity, None)
+		self.sent_movement.update(moved)
+	
+	# An update that will never be received, so whatever it was about has to
+	# be checked again
+	def lose(self, update):
+		tick, entities, removed, moved = update
+		self.stale.update(entities)
+		self.stale.update(removed)
+	
+	def _enqueue(self, packet, update):
+		if self.overflowed or self.suspended:
+			return False
+		
+		if self.queued_bytes + len(packet) > self.max_buffer:
+			# A dropped update was never acknowledged, so the next one makes up
+			# for it
+			if update is not None and self.overflow_policy == 'drop':
+				self.lose(update)
+				self.frames_dropped += 1
+				return False
+			
+			self.log('Send buffer overflow, disconnecting')
+			self.overflowed = True
+			self.frames_dropped += len(self.queue) + 1
+			self.queue.clear()
+			self.queued_bytes = 0
+			asyncio.ensure_future(self.close('Send buffer overflow'))
+			return False
+		
+		self.queue.append((packet, update))
+		self.queued_bytes += len(packet)
+		self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+		self.queue_ready.set()
+		return True
+	
+	# name is the packet's type, for the metrics
+	def queue_packet(self, packet, name=None):
+		if metrics.enabled and name:
+			metrics.count_packet('out', name, len(packet))
+		return self._enqueue(packet, None)
+	
+	# update is (tick, entities, removed, moved), as taken by acknowledge
+	def queue_update(self, packet, update):
+		if metrics.enabled:
+			metrics.count_packet('out', 'S_UpdateWorld', len(packet))
+		return self._enqueue(packet, update)
+	
+	# Drops any world updates that haven't gone out yet, since the next one
+	# supersedes them. They were never acknowledged, so whatever they carried,
+	# movement included, is sent again in the next.
+	def drop_pending_updates(self):
+		if not self.queue:
+			return
+		pending = [item for item in self.queue if item[1] is not None]
+		for item in pending:
+			self.queue.remove(item)
+			self.queued_bytes -= len(item[0])
+			self.lose(item[1])
+			self.frames_coalesced += 1
+	
+	# Forgets that the client was ever sent anything, before it's sent the
+	# world afresh
+	def reset_sent(self):
+		# Updates from another world must not be acknowledged in this one
+		self.drop_pending_updates()
+		self.sent_movement.clear()
+		self.sent.clear()
+		self.ready = False
+		self.view_cell = None
+		self.view = None
+		self.visible = set()
+		self.visible_moving = set()
+		self.stale.clear()
+		self.updates_sent = 0
+		self.acknowledged.clear()
+	
+	# Stops sending to a client that disconnected, until it resumes
+	def suspend(self):
+		self.stop_writer()
+		self.suspended = True
+		for packet, update in self.queue:
+			if update is not None:
+				self.lose(update)
+		self.queue.clear()
+		self.queued_bytes = 0
+	
+	# Picks up on a new websocket where the client left off, if it has
+	# received updates that were sent recently enough to take back the rest.
+	# Otherwise the client has to be sent the world again.
+	def resume(self, ws, received):
+		self.ws = ws
+		self.overflowed = False
+		lost = self.updates_sent - received if received is not None else -1
+		if not 0 <= lost <= len(self.acknowledged):
+			return False
+		
+		sent = self.sent
+		sent_movement = self.sent_movement
+		for _ in range(lost):
+			for entity, tick, movement in reversed(self.acknowledged.pop()):
+				if tick is None:
+					sent.pop(entity, None)
+				else:
+					sent[entity] = tick
+				if movement is None:
+					sent_movement.pop(entity, None)
+				else:
+					sent_movement[entity] = movement
+		self.updates_sent = received
+		# Changes made while it was away weren't sent to it
+		self.stale |= self.visible
+		self.stale.update(sent)
+		self.suspended = False
+		return True
+	
 	async def recv(self):
-		return packets.unpack(self, await self.ws.recv())
+		data = await self.ws.recv()
+		p = self.packets.unpack(self, data)
+		if metrics.enabled:
+			metrics.count_packet('in', p.ptype.name, len(data))
+		return p
 	
 	async def close(self, reason):
-		print('close')
+		self.log('close')
 		await self.ws.close(reason=reason)
 	
 	def log(self, *args):
@@ -39,38 +324,141 @@ class WSClient:
 				if not self.ws.open:
 					break
 				
-				p = await self.recv()
-				
-				if p.ptype == packets.C_UpdateSelf:
-					if hasattr(p, 'pos'):
-						self.entity.pos = Point(*p.pos)
-					if hasattr(p, 'rot'):
-						self.entity.rot = p.rot
-					if hasattr(p, 'speech'):
-						self.entity.speech = p.speech
-					if hasattr(p, 'bellType'):
-						self.entity.bell_type = p.bellType
-					if hasattr(p, 'gut'):
-						for char, count in p.gut.items():
-							self.entity.gut[char] = count
-					if hasattr(p, 'textActs'):
-						for act in p.textActs:
-							try:
-								self.entity.add_text_act(act)
-							except Exception as e:
-								self.log('Failed to load text act', act, e)
-				elif p.ptype == packets.C_MakeBox:
-					box = Box(p.pos, p.rot, p.text)
-					self.world.add_entity(box)
-				elif p.ptype == packets.C_MakePlant:
-					plant = Plant(p.pos, p.rot, p.text)
-					self.world.add_entity(plant)
-				elif p.ptype == packets.C_Destroy:
-					self.world.remove_entity(self.world.entities.get(p.id))
-				else:
-					self.log('UNEXPECTED PACKET:', p)
+				self.handle(await self.recv())
 		except BaseException as e:
 			self.log(e)
 			raise
 		finally:
 			self.log('Stop running')
+	
+	def reject(self, name, reason):
+		self.rejected[reason] = self.rejected.get(reason, 0) + 1
+		if metrics.enabled:
+			metrics.count_rejected(name, reason)
+	
+	# Returns why a packet must be refused, if it must. Parts of a packet that
+	# can be fixed are, such as cutting a move short.
+	def check(self, p, now):
+		name = p.ptype.name
+		rate = self.packet_rates.get(name)
+		if rate is None:
+			return 'unexpected'
+		bucket = self.buckets.get(name)
+		if bucket is None:
+			bucket = self.buckets[name] = TokenBucket(*rate, now)
+		if not bucket.take(now):
+			return 'rate'
+		
+		if p.ptype == self.packets.C_UpdateSelf:
+			return self.check_update(p, now)
+		elif p.ptype == self.packets.C_MakeBox or p.ptype == self.packets.C_MakePlant:
+			if not (is_pos(getattr(p, 'pos', None))
+					and is_number(getattr(p, 'rot', None))
+					and is_text(getattr(p, 'text', None), self.max_text)):
+				return 'invalid'
+			x, y = p.pos
+			if not self.in_reach((x, y, x, y)):
+				return 'reach'
+			corpus = getattr(p, 'corpus', None)
+			if corpus is not None and not is_text(corpus, self.max_text):
+				return 'invalid'
+			type_id = 'box' if p.ptype == self.packets.C_MakeBox else 'plant'
+			if not self.world.has_room(type_id):
+				return 'quota'
+		elif p.ptype == self.packets.C_Destroy:
+			if not isinstance(getattr(p, 'id', None), str):
+				return 'invalid'
+			entity = self.world.entities.get(p.id)
+			if entity is None:
+				# Someone else got there first
+				return None
+			if isinstance(entity, (Ant, TerrBlock)):
+				return 'invalid'
+			if not self.in_reach(entity.aabb):
+				return 'reach'
+		return None
+	
+	def check_update(self, p, now):
+		name = p.ptype.name
+		if hasattr(p, 'pos') and not is_pos(p.pos):
+			return 'invalid'
+		if hasattr(p, 'rot') and not is_number(p.rot):
+			return 'invalid'
+		# Speech is only started or stopped; what's said follows from text
+		# acts, as the gut does
+		if hasattr(p, 'speech') and p.speech not in (None, ''):
+			return 'invalid'
+		if hasattr(p, 'bellType') and not (
+				p.bellType is None or is_text(p.bellType, self.max_text)):
+			return 'invalid'
+		if hasattr(p, 'textActs') and not (
+				isinstance(p.textActs, list)
+				and all(isinstance(act, dict) for act in p.textActs)):
+			return 'invalid'
+		
+		if hasattr(p, 'gut'):
+			# The gut follows from text acts; clients can't set it
+			del p.gut
+			self.reject(name, 'gut')
+		if hasattr(p, 'textActs') and len(p.textActs) > self.max_text_acts:
+			del p.textActs[self.max_text_acts:]
+			self.reject(name, 'text_acts')
+		if hasattr(p, 'pos'):
+			elapsed = min(now - self.moved_at, 1)
+			self.moved_at = now
+			x, y = self.entity.pos
+			dx = p.pos[0] - x
+			dy = p.pos[1] - y
+			distance = math.hypot(dx, dy)
+			allowed = self.max_speed * elapsed + self.move_slack
+			if distance > allowed:
+				scale = allowed / distance
+				p.pos = [x + dx * scale, y + dy * scale]
+				self.entity.correcting = True
+				self.reject(name, 'speed')
+		return None
+	
+	def in_reach(self, aabb):
+		return (aabb_sqr_distance(aabb, self.entity.pos)
+			<= self.max_reach * self.max_reach)
+	
+	def handle(self, p):
+		if self.limited:
+			reason = self.check(p, time.monotonic())
+			if reason:
+				self.reject(p.ptype.name, reason)
+				return
+		
+		self.world.record(p.ptype.name, self.face,
+			{k: v for k, v in vars(p).items() if k != 'ptype'})
+		
+		if p.ptype == self.packets.C_UpdateSelf:
+			if hasattr(p, 'pos'):
+				self.entity.pos = Point(*p.pos)
+			if hasattr(p, 'rot'):
+				self.entity.rot = p.rot
+			if hasattr(p, 'speech'):
+				self.entity.speech = p.speech
+			if hasattr(p, 'bellType'):
+				self.entity.bell_type = p.bellType
+			if hasattr(p, 'textActs'):
+				for act in p.textActs:
+					try:
+						self.entity.add_text_act(act)
+					except (KeyError, TypeError, ValueError):
+						self.reject(p.ptype.name, 'text_act')
+		elif p.ptype == self.packets.C_MakeBox:
+			box = Box(p.pos, p.rot, p.text)
+			self.world.add_entity(box)
+		elif p.ptype == self.packets.C_MakePlant:
+			corpus = getattr(p, 'corpus', None)
+			if corpus not in markov.corpora:
+				corpus = None
+			plant = Plant(p.pos, p.rot, p.text, corpus)
+			self.world.add_entity(plant)
+		elif p.ptype == self.packets.C_Destroy:
+			entity = self.world.entities.get(p.id)
+			if entity:
+				self.world.remove_entity(entity)
+		else:
+			self.log('UNEXPECTED PACKET:', p)
@@ -1,5 +1,5 @@
 from collections import namedtuple
-from uuid import uuid4
+import math
 
 class Point(namedtuple('_Point', ['x', 'y'])):
 	__slots__ = ()
@@ -18,33 +18,51 @@ class Point(namedtuple('_Point', ['x', 'y'])):
 	def magnitude(self):
 		return (self[0] * self[0] + self[1] * self[1]) ** 0.5
 
+def rotated_aabb(pos, rot, half_width, half_height):
+	x, y = pos
+	c = abs(math.cos(rot))
+	s = abs(math.sin(rot))
+	hw = c * half_width + s * half_height
+	hh = s * half_width + c * half_height
+	return (x - hw, y - hh, x + hw, y + hh)
+
+# Each networked property has a bit in an entity's dirty flags
+dirty_bits = {}
+
+def dirty_bit(name):
+	return dirty_bits.setdefault(name, 1 << len(dirty_bits))
+
 def dataprop(name):
+	bit = dirty_bit(name)
+	
 	def getter(self):
 		return self.data.get(name)
 	
 	def setter(self, value):
 		self.data[name] = value
-		self.diff[name] = value
+		self.mark_dirty(bit)
 	
 	return property(getter, setter)
 
 class EntityBase:
+	__slots__ = ('world', 'handle', 'id', 'static', 'data', 'dirty', 'version',
+		'aabb')
+	radius = 0
+	
 	def __init__(self, pos, rot=0, *, id=None, static=False):
 		self.world = None
+		# Assigned by the world. Entities without an id are named after
+		# their handle, which can never collide with a 5 character face.
+		self.handle = None
+		self.id = id
+		self.static = static
 		self.data = {'type': type(self).type_id}
-		self.diff = {}
-		self.seen_by = set()
-		self.temp_seen_by = set()
-		
-		if static or not id:
-			uuid = uuid4()
-		
-		self.id = id or str(uuid)
-		
-		if static:
-			self.static_id = int(uuid) % 2**32
-		else:
-			self.static_id = None
+		self.dirty = 0
+		# The last tick the entity changed in, set by the world
+		self.version = 0
+		# The box the world finds the entity by. Worked out once for static
+		# entities, and again whenever the others move.
+		self.aabb = None
 		
 		self.pos = pos
 		self.rot = rot
@@ -54,12 +72,42 @@ class EntityBase:
 	
 	@property
 	def is_static(self):
-		return self.static_id != None
+		return self.static
+	
+	def mark_dirty(self, bit):
+		if not self.dirty and self.world is not None:
+			self.world.dirty_entities.append(self)
+		self.dirty |= bit
+	
+	# Changes since the last tick, built from the dirty flags
+	@property
+	def diff(self):
+		dirty = self.dirty
+		if not dirty:
+			return {}
+		return {
+			name: self.diff_value(name)
+			for name, bit in dirty_bits.items() if dirty & bit
+		}
+	
+	def diff_value(self, name):
+		return self.data.get(name)
+	
+	def clear_diff(self):
+		self.dirty = 0
+	
+	# Called before a changed entity is sent, for entities that keep some of
+	# their data in other forms
+	def sync_data(self):
+		pass
+	
+	# Oriented bounding box: (center, rotation, half width, half height)
+	def get_obb(self):
+		return (self.pos, 0, self.radius, self.radius)
 	
+	# Costly; read aabb instead, unless placing the entity
 	def get_aabb(self):
-		x, y = self.pos
-		r = self.radius
-		return (x - r, y - r, x + r, y + r)
+		return rotated_aabb(*self.get_obb())
 	
 	def on_removed(self):
 		self.world = None
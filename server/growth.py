@@ -0,0 +1,122 @@
+import math
+import time
+import numpy as np
+from server.metrics import metrics
+from server.plant import Word, word_obb
+
+# Grows every plant in a world together, a batch of branches per tick
+class PlantGrowth:
+	# Words per plant, and branches per word
+	max_words = 25
+	max_branches = 2
+	# Placements tried per branch, and failed branches before a word is pruned
+	tries = 4
+	max_rejections = 3
+
+	def __init__(self, rate=0.25, max_per_tick=64, shape=0.7, seed=None):
+		# Branch attempts per plant per second
+		self.rate = rate
+		# Bounds the tick cost however many plants there are
+		self.max_per_tick = max_per_tick
+		# Structural determination: words are picked by x^shape. A tree may be
+		# best represented by around 0.5; a shrub by 2
+		self.shape = shape
+		self.rng = np.random.default_rng(seed)
+		self.credit = 0.0
+
+	def step(self, world):
+		plants = [p for p in world.plants if len(p.words) < self.max_words]
+		if not plants:
+			self.credit = 0.0
+			return
+
+		self.credit += self.rate * len(plants) / world.tick_rate
+		count = min(int(self.credit), len(plants), self.max_per_tick)
+		self.credit -= int(self.credit)
+		if count == 0:
+			return
+
+		picked = [plants[i] for i in self.rng.choice(len(plants), count, replace=False)]
+		growing = []
+		for plant in picked:
+			if plant.words:
+				growing.append(plant)
+			else:
+				plant.seed()
+		if growing:
+			self.branch(growing)
+
+	def branch(self, plants):
+		sizes = np.array([len(p.words) for p in plants])
+		picks = (self.rng.random(len(plants)) ** self.shape * (sizes - 0.001)).astype(np.intp)
+		parents = [
+			word for word in (p.words[i] for p, i in zip(plants, picks.tolist()))
+			if word.alive and len(word.branches) < self.max_branches
+			and word.rejected < self.max_rejections
+		]
+		if not parents:
+			return
+
+		start = time.perf_counter()
+		next_words = self.next_words(parents)
+		if metrics.enabled:
+			metrics.observe(parents[0].world.id, 'markov', time.perf_counter() - start)
+
+		rot = np.array([w.rot for w in parents])
+		plant_rot = np.array([w.parent_plant.rot for w in parents])
+		sibling_rot = np.array([w.branches[0].rot if w.branches else 0.0 for w in parents])
+		has_sibling = np.array([len(w.branches) == 1 for w in parents])
+		x = np.array([w.pos[0] for w in parents])
+		y = np.array([w.pos[1] for w in parents])
+		length = (np.array([len(w.text) for w in parents]) + 1) * 5
+		next_length = (np.array([len(t) for t in next_words]) + 1) * 5
+
+		# This should be tree-only code. Each row holds a few placements to
+		# try in turn, should the first overlap something.
+		rot = rot[:, None]
+		plant_rot = plant_rot[:, None]
+		r = self.rng.random((len(parents), self.tries))
+		angle = np.where(has_sibling[:, None],
+			rot + (rot - sibling_rot[:, None]) * 0.3 * r,
+			rot + (r - 0.5) * 1.2)
+		upright = plant_rot + math.pi/2
+		angle = np.where(np.abs(angle - upright) > math.pi/3,
+			(angle + plant_rot - math.pi/2) / 2,
+			angle)
+
+		# Offset by the current word, then by the next one
+		next_length = next_length[:, None]
+		new_x = (x + np.cos(rot[:, 0]) * length)[:, None] + np.cos(angle) * next_length
+		new_y = (y + np.sin(rot[:, 0]) * length)[:, None] + np.sin(angle) * next_length
+
+		for parent, text, angles, xs, ys in zip(parents, next_words,
+				angle.tolist(), new_x.tolist(), new_y.tolist()):
+			# Words may touch their own family where they join
+			family = (parent, parent.parent_plant, *parent.branches)
+			for a, nx, ny in zip(angles, xs, ys):
+				if any(abs(b.rot - a) < 0.3 or b.text == text for b in parent.branches):
+					continue
+				if parent.world.obstructed(word_obb((nx, ny), a, text), family):
+					continue
+				w = Word((nx, ny), a, text, parent.parent_plant, parent)
+				parent.branches.append(w)
+				parent.parent_plant.words.append(w)
+				parent.world.add_word(w)
+				break
+			else:
+				parent.rejected += 1
+				# Saved with the word, so it isn't retried after a restore
+				parent.world.unsaved.add(parent)
+
+	# Samples the next word of every parent, a batch per Markov source
+	def next_words(self, parents):
+		batches = {}
+		for i, word in enumerate(parents):
+			batches.setdefault(word.parent_plant.markov, []).append(i)
+
+		next_words = [None] * len(parents)
+		for source, indices in batches.items():
+			pairs = [(parents[i].text, parents[i].parent_word) for i in indices]
+			for i, text in zip(indices, source.chain_many(pairs, self.rng)):
+				next_words[i] = text
+		return next_words
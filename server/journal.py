@@ -0,0 +1,82 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+from server.packets_bin import write_value, read_value
+
+# Append-only journal of everything that changes a world: what it starts out
+# with, clients joining and leaving, the packets they send, and the words
+# plants grow. Records are batched in memory and written from a background
+# task with buffered I/O. Each record is a list, encoded like a binary packet
+# value with exact floats:
+#   [milliseconds since start, world id, world tick, event, face, fields]
+# See replay.py for reading one back.
+
+MAGIC = b'CBJ1'
+
+class Journal:
+	def __init__(self, directory, interval=0.5):
+		os.makedirs(directory, exist_ok=True)
+		self.fileName = os.path.join(directory,
+			f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.journal')
+		# Seconds between writes
+		self.interval = interval
+		self.start = time.monotonic()
+		self.pending = []
+		self.file = None
+		self.records_written = 0
+		# Only one batch is written at a time, in order
+		self.lock = asyncio.Lock()
+
+	def record(self, world, event, face=None, fields=None):
+		self.pending.append([
+			round((time.monotonic() - self.start) * 1000),
+			world.id, world.tick, event, face, fields])
+
+	def write(self, batch):
+		if self.file is None:
+			self.file = open(self.fileName, 'ab', buffering=1 << 16)
+			if self.file.tell() == 0:
+				self.file.write(MAGIC)
+		out = bytearray()
+		for record in batch:
+			write_value(out, record, exact=True)
+		self.file.write(out)
+		self.file.flush()
+		self.records_written += len(batch)
+
+	async def flush(self):
+		async with self.lock:
+			batch = self.pending
+			self.pending = []
+			if batch:
+				loop = asyncio.get_running_loop()
+				await loop.run_in_executor(None, self.write, batch)
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			try:
+				await self.flush()
+			except OSError as e:
+				print('Could not write journal', self.fileName, e)
+
+def read_journal(fileName):
+	with open(fileName, 'rb') as f:
+		if os.fstat(f.fileno()).st_size <= len(MAGIC):
+			return
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	with data:
+		if data[:len(MAGIC)] != MAGIC:
+			raise ValueError(f'{fileName} is not a journal')
+		i = len(MAGIC)
+		while i < len(data):
+			try:
+				record, i = read_value(data, i)
+			except (IndexError, ValueError, struct.error):
+				# Cut short by a crash
+				print('Ignoring the end of', fileName, 'from byte', i)
+				return
+			yield record
@@ -0,0 +1,39 @@
+import math
+
+# Checks on what clients send, before it's applied to a world
+
+# Lets through rate events per second on average, and up to burst at once
+class TokenBucket:
+	__slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+	def __init__(self, rate, burst, now):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = now
+
+	def take(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+def is_number(value):
+	return (isinstance(value, (int, float)) and not isinstance(value, bool)
+		and math.isfinite(value))
+
+def is_pos(value):
+	return (isinstance(value, (list, tuple)) and len(value) == 2
+		and is_number(value[0]) and is_number(value[1]))
+
+def is_text(value, max_length):
+	return isinstance(value, str) and len(value) <= max_length
+
+# Faces are ant ids, so can't look like the ids given to other entities
+def is_face(value):
+	return isinstance(value, str) and len(value) == 5 and '#' not in value
+
+def is_char(value):
+	return isinstance(value, str) and len(value) == 1
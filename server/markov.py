@@ -1,73 +1,462 @@
-from collections import Counter, defaultdict
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import accumulate
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import numpy as np
+import os
+import pickle
 import random
 import string
 import re
+import sys
 # markov.py - deals with branching of plants
 
-# markov word class
+# Compiled sources are cached next to the text they came from
+CACHE_DIR_NAME = ".markovcache"
+# Bump when the compiled format changes
+CACHE_VERSION = 3
+# Bytes of text counted per background job
+CHUNK_SIZE = 1 << 20
+
+WORD_SPLIT = re.compile("[_\"\-\-,. !?“”—1234567890]|\s+| |(?<=\s\r)[\']|[\'](?=\s)")
+
+def split_words(lines):
+    for line in lines:
+        line = line.strip("\n")
+        if len(line) == 0:
+            continue
+        for word in WORD_SPLIT.split(line):
+            word = word.strip(string.punctuation)
+            if len(word) > 0:
+                yield word
+
+# Words starting with a capital letter (but not all-caps ones) can start a
+# sentence
+def starts_sentence(word):
+    return word[0].isupper() and (len(word) == 1 or not word[1].isupper())
+
+# Counts transitions by word rather than by token, so counts made in
+# another process can be merged into any source
+def count_words(lines):
+    unigrams = defaultdict(int)
+    bigrams = defaultdict(int)
+    starts = defaultdict(int)
+    last_last_word = ""
+    last_word = ""
+    for word in split_words(lines):
+        unigrams[(last_word, word)] += 1
+        bigrams[(last_last_word, last_word, word)] += 1
+        if starts_sentence(word):
+            starts[word] += 1
+        last_last_word = last_word
+        last_word = word
+    return dict(unigrams), dict(bigrams), dict(starts)
+
+# Counts the lines starting in [start, end) of a text. A line that crosses a
+# boundary belongs to the chunk it starts in. Each chunk restarts the chain,
+# which costs one spurious sentence start per chunk.
+def count_range(fileName, start, end):
+    with open(fileName, "rb") as text_file:
+        if start > 0:
+            text_file.seek(start - 1)
+            text_file.readline()
+        lines = []
+        while text_file.tell() < end:
+            line = text_file.readline()
+            if not line:
+                break
+            lines.append(line)
+    text = b"".join(lines).decode("utf-8-sig" if start == 0 else "utf-8")
+    return count_words(io.StringIO(text, newline=None))
+
+def chunk_ranges(fileName, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(fileName)
+    return [(start, min(start + chunk_size, size))
+        for start in range(0, size, chunk_size)]
+
+# markov word class: counts of the words that follow a state, while a
+# source is loading. Sampling is done from the compiled TransitionTables.
 class Phrase:
     def __init__(self):
         self.size = 0
-        self.contents = Counter()
-    
-    def add_word(self, addition):
-        self.contents[addition] += 1
-        self.size += 1
+        # A plain dict rather than a Counter, since it's faster to fill
+        self.contents = {}
     
-    def get_word(self):
-        if(self.size > 0):
-            index = random.randrange(self.size)
-            c = 0
-            for word, count in self.contents.items():
-                c += count
-                if c >= index:
-                    return word
-        else:
-            return ""
+    def add_word(self, addition, times=1):
+        self.contents[addition] = self.contents.get(addition, 0) + times
+        self.size += times
+
+# Array-backed transitions for every state of one order. Each state's next
+# tokens and their running count totals are stored contiguously, so a state
+# costs a few array slots instead of a Phrase with its own dict.
+class TransitionTable:
+    def __init__(self, phrases=()):
+        self.index = {}
+        self.offsets = array("I", [0])
+        self.words = array("I")
+        self.cumulative = array("I")
+        for key, phrase in phrases:
+            self.index[key] = len(self.offsets) - 1
+            self.words.extend(phrase.contents.keys())
+            self.cumulative.extend(accumulate(phrase.contents.values()))
+            self.offsets.append(len(self.words))
+        self.flat = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def sample(self, key):
+        i = self.index.get(key)
+        if i is None:
+            return None
+        lo = self.offsets[i]
+        hi = self.offsets[i + 1]
+        index = random.randrange(self.cumulative[hi - 1])
+        return self.words[bisect_right(self.cumulative, index, lo, hi)]
+
+    # Running totals over the whole table, so one searchsorted can sample
+    # many states at once. Built on first use.
+    def flat_cumulative(self):
+        if self.flat is None:
+            offsets = np.frombuffer(self.offsets, dtype=np.uint32)
+            cumulative = np.frombuffer(self.cumulative, dtype=np.uint32)
+            totals = cumulative[offsets[1:] - 1].astype(np.int64)
+            bases = np.concatenate(([0], np.cumsum(totals)[:-1]))
+            self.flat = cumulative + np.repeat(bases, np.diff(offsets))
+        return self.flat
+
+    # Samples the next token of each state in keys, or -1 for unknown states
+    def sample_many(self, keys, rng):
+        result = np.full(len(keys), -1, dtype=np.int64)
+        index = np.fromiter((self.index.get(key, -1) for key in keys),
+            dtype=np.int64, count=len(keys))
+        found = index >= 0
+        if not found.any():
+            return result
+        offsets = np.frombuffer(self.offsets, dtype=np.uint32)
+        cumulative = np.frombuffer(self.cumulative, dtype=np.uint32)
+        flat = self.flat_cumulative()
+        lo = offsets[index[found]].astype(np.int64)
+        hi = offsets[index[found] + 1].astype(np.int64)
+        base = flat[lo] - cumulative[lo]
+        draws = base + rng.integers(0, cumulative[hi - 1])
+        picks = np.searchsorted(flat, draws, side="right")
+        result[found] = np.frombuffer(self.words, dtype=np.uint32)[picks]
+        return result
+
+    def phrases(self):
+        for key, i in self.index.items():
+            phrase = Phrase()
+            last = 0
+            for j in range(self.offsets[i], self.offsets[i + 1]):
+                phrase.contents[self.words[j]] = self.cumulative[j] - last
+                last = self.cumulative[j]
+            phrase.size = last
+            yield key, phrase
+
+    def nbytes(self):
+        size = sys.getsizeof(self.index) + sum(map(sys.getsizeof, self.index))
+        for a in (self.offsets, self.words, self.cumulative):
+            size += sys.getsizeof(a)
+        if self.flat is not None:
+            size += self.flat.nbytes
+        return size
+
+    # The flat totals are derived, so they aren't pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["flat"] = None
+        return state
 
 class MarkovSource:
     def __init__(self):
-        # Dictionaries should persist after the sourcetexts.
+        # Words are interned as integer tokens. Token 0 is the empty word,
+        # which starts sentences.
+        self.tokens = [""]
+        self.token_ids = {"": 0}
+        # Counts while loading, keyed by previous token and by
+        # (previous previous, previous) token pairs
         self.dictionary = defaultdict(Phrase)
         self.dictionary2 = defaultdict(Phrase)
-    
+        # Compiled from the counts once loading is done
+        self.unigrams = TransitionTable()
+        self.bigrams = TransitionTable()
+
+    def intern(self, word):
+        token = self.token_ids.get(word)
+        if token is None:
+            token = self.token_ids[word] = len(self.tokens)
+            self.tokens.append(word)
+        return token
+
     def load(self, fileName):
-        with open(fileName, encoding="utf-8") as text_file:
-
-            last_last_word = ""
-            last_word = ""
-            for line in text_file:
-                line = line.strip("\n")
-                if len(line) == 0:
-                    continue
-                #print(line)
-                for word in re.split("[_\"\-\-,. !?“”—1234567890]|\s+| |(?<=\s\r)[\']|[\'](?=\s)", line):
-                    word = word.strip(string.punctuation)
-                    if len(word) == 0:
-                        #print("length 0")
-                        continue
-                    self.dictionary[last_word].add_word(word)
-                    #print(last_last_word + last_word)
-                    self.dictionary2[last_last_word + last_word].add_word(word)
-                    # add it to "" if it starts with a capital letter.
-                    if word[0].isupper():
-                        if len(word) > 1:
-                            if not word[1].isupper():
-                                self.dictionary[""].add_word(word)
-                                self.dictionary2[""].add_word(word)
-                        else:
-                            self.dictionary[""].add_word(word)
-                            self.dictionary2[""].add_word(word)
-                    last_last_word = last_word
-                    last_word = word
-    
+        self.thaw()
+
+        with open(fileName, encoding="utf-8-sig") as text_file:
+            self.add_counts(count_words(text_file))
+        self.compile()
+
+    def add_counts(self, counts):
+        unigrams, bigrams, starts = counts
+        intern = self.intern
+        for (last_word, word), count in unigrams.items():
+            self.dictionary[intern(last_word)].add_word(intern(word), count)
+        for (last_last_word, last_word, word), count in bigrams.items():
+            key = (intern(last_last_word), intern(last_word))
+            self.dictionary2[key].add_word(intern(word), count)
+        # add it to "" if it starts with a capital letter.
+        for word, count in starts.items():
+            token = intern(word)
+            self.dictionary[0].add_word(token, count)
+            self.dictionary2[(0, 0)].add_word(token, count)
+
+    def compile(self):
+        self.unigrams = TransitionTable(self.dictionary.items())
+        self.bigrams = TransitionTable(self.dictionary2.items())
+        self.dictionary = defaultdict(Phrase)
+        self.dictionary2 = defaultdict(Phrase)
+
+    # Turns the compiled tables back into counts, so more text can be added
+    def thaw(self):
+        if len(self.unigrams) > 0:
+            self.dictionary.update(self.unigrams.phrases())
+            self.dictionary2.update(self.bigrams.phrases())
+            self.unigrams = TransitionTable()
+            self.bigrams = TransitionTable()
+
+    def __getstate__(self):
+        if self.dictionary:
+            self.compile()
+        return (self.tokens, self.unigrams, self.bigrams)
+
+    def __setstate__(self, state):
+        self.tokens, self.unigrams, self.bigrams = state
+        self.token_ids = {word: i for i, word in enumerate(self.tokens)}
+        self.dictionary = defaultdict(Phrase)
+        self.dictionary2 = defaultdict(Phrase)
+
+    def memory_report(self):
+        return {
+            "tokens": len(self.tokens),
+            "unigram_states": len(self.unigrams),
+            "bigram_states": len(self.bigrams),
+            "transitions": len(self.unigrams.words) + len(self.bigrams.words),
+            "bytes": (
+                sys.getsizeof(self.tokens)
+                + sum(map(sys.getsizeof, self.tokens))
+                + sys.getsizeof(self.token_ids)
+                + self.unigrams.nbytes()
+                + self.bigrams.nbytes()),
+        }
+
+    @staticmethod
+    def cache_name(fileName):
+        # Named by a hash of the text, so edited texts are compiled again
+        with open(fileName, "rb") as text_file:
+            digest = hashlib.sha1(text_file.read()).hexdigest()
+
+        directory, name = os.path.split(os.path.abspath(fileName))
+        return os.path.join(directory, CACHE_DIR_NAME,
+            f"{name}-{digest}-v{CACHE_VERSION}.pickle")
+
+    @staticmethod
+    def cached(cacheName):
+        try:
+            with open(cacheName, "rb") as cache_file:
+                return pickle.load(cache_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+
+    @classmethod
+    def compiled(cls, fileName):
+        # Loads a source from its compiled cache, building and caching it if
+        # the text has changed since (or was never compiled).
+        cacheName = cls.cache_name(fileName)
+        source = cls.cached(cacheName)
+        if source is None:
+            source = cls()
+            source.load(fileName)
+            source.save(cacheName)
+        return source
+
+    @classmethod
+    def from_text(cls, text):
+        source = cls()
+        source.add_counts(count_words(text.splitlines()))
+        source.compile()
+        return source
+
+    def save(self, fileName):
+        try:
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            tempName = f"{fileName}.{os.getpid()}.tmp"
+            with open(tempName, "wb") as cache_file:
+                pickle.dump(self, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempName, fileName)
+        except OSError as e:
+            print("Could not save compiled Markov source", fileName, e)
+
     def chain(self, word_curr, word_prev):
-        st = self.dictionary2[word_prev+word_curr].get_word()
-        if st == "" or random.randrange(7) < 2:
-            st = self.dictionary[word_curr].get_word()
-        if st == "":
-            st = self.dictionary[""].get_word()
-        return st
+        curr = self.token_ids.get(word_curr)
+        prev = self.token_ids.get(word_prev)
+        st = None
+        if curr is not None and prev is not None:
+            st = self.bigrams.sample((prev, curr))
+        if st is None or random.randrange(7) < 2:
+            st = self.unigrams.sample(curr)
+        if st is None:
+            st = self.unigrams.sample(0)
+        return "" if st is None else self.tokens[st]
+
+    # chain() for many (word_curr, word_prev) pairs at once
+    def chain_many(self, pairs, rng):
+        token_ids = self.token_ids
+        curr = np.fromiter((token_ids.get(c, -1) for c, p in pairs),
+            dtype=np.int64, count=len(pairs))
+        prev = np.fromiter((token_ids.get(p, -1) for c, p in pairs),
+            dtype=np.int64, count=len(pairs))
+        known = (curr >= 0) & (prev >= 0)
+        st = np.full(len(pairs), -1, dtype=np.int64)
+        st[known] = self.bigrams.sample_many(
+            list(zip(prev[known].tolist(), curr[known].tolist())), rng)
+        # Mixed order: sometimes ignore the bigram even if there is one
+        retry = (st < 0) | (rng.integers(0, 7, len(pairs)) < 2)
+        st[retry] = self.unigrams.sample_many(curr[retry].tolist(), rng)
+        missing = st < 0
+        st[missing] = self.unigrams.sample_many([0] * int(missing.sum()), rng)
+        tokens = self.tokens
+        return ["" if t < 0 else tokens[t] for t in st.tolist()]
+
+# Compiled sources, shared by every world in the process
+sources = {}
+# Background loads in progress, by file name
+loading = {}
+executor = None
+
+def load_source(fileName):
+    fileName = os.path.abspath(fileName)
+    source = sources.get(fileName)
+    if source is None:
+        source = sources[fileName] = MarkovSource.compiled(fileName)
+    return source
+
+def get_executor():
+    global executor
+    if executor is None:
+        workers = min(4, os.cpu_count() or 1)
+        # Daemon processes (world workers) may not start children
+        if multiprocessing.current_process().daemon:
+            executor = ThreadPoolExecutor(workers)
+        else:
+            executor = ProcessPoolExecutor(workers)
+    return executor
+
+# Counts a text in chunks on the executor, merging each chunk's counts as it
+# finishes. Merging and compiling run on a thread, off the event loop.
+async def stream_source(fileName):
+    loop = asyncio.get_running_loop()
+    source = MarkovSource()
+    chunks = [
+        loop.run_in_executor(get_executor(), count_range, fileName, start, end)
+        for start, end in chunk_ranges(fileName)
+    ]
+    for chunk in asyncio.as_completed(chunks):
+        await loop.run_in_executor(None, source.add_counts, await chunk)
+    await loop.run_in_executor(None, source.compile)
+    return source
+
+async def load_source_async(fileName):
+    fileName = os.path.abspath(fileName)
+    source = sources.get(fileName)
+    if source is not None:
+        return source
+
+    loop = asyncio.get_running_loop()
+    cacheName = await loop.run_in_executor(None, MarkovSource.cache_name, fileName)
+    source = await loop.run_in_executor(None, MarkovSource.cached, cacheName)
+    if source is None:
+        source = await stream_source(fileName)
+        await loop.run_in_executor(None, source.save, cacheName)
+    # Only ever published whole, so readers see the fallback or the finished
+    # source and nothing in between
+    return sources.setdefault(fileName, source)
+
+def start_loading(fileName):
+    if fileName in sources or fileName in loading:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Nothing to run it yet; it starts the next time it's asked for
+        return
+
+    def done(task):
+        del loading[fileName]
+        if not task.cancelled() and task.exception() is not None:
+            print("Could not load Markov source", fileName, task.exception())
+
+    task = loading[fileName] = loop.create_task(load_source_async(fileName))
+    task.add_done_callback(done)
+
+FALLBACK_TEXT = """
+The world is made of words. Words grow into plants.
+Plants grow into more words. The bugs walk among the plants and talk.
+"""
+fallback_source = None
+
+SOURCETEXT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sourcetext")
+DEFAULT_CORPUS = "AliceInWonderland"
+
+# Every text in sourcetext/, by file name without the extension
+corpora = {
+    os.path.splitext(name)[0]: os.path.join(SOURCETEXT_DIR, name)
+    for name in sorted(os.listdir(SOURCETEXT_DIR))
+    if name.endswith(".txt")
+}
+
+def get_corpus(name=DEFAULT_CORPUS):
+    try:
+        fileName = corpora[name]
+    except KeyError:
+        raise KeyError(f"Unknown corpus {name}")
+    return load_source(fileName)
+
+def fallback():
+    global fallback_source
+    source = sources.get(corpora[DEFAULT_CORPUS])
+    if source is None:
+        if fallback_source is None:
+            fallback_source = MarkovSource.from_text(FALLBACK_TEXT)
+        source = fallback_source
+    return source
+
+# Never blocks: until the corpus has loaded in the background, a stand-in
+# source is returned instead
+def corpus_or_fallback(name=DEFAULT_CORPUS):
+    try:
+        fileName = corpora[name]
+    except KeyError:
+        raise KeyError(f"Unknown corpus {name}")
+    source = sources.get(fileName)
+    if source is None:
+        start_loading(fileName)
+        source = fallback()
+    return source
+
+def preload(name=DEFAULT_CORPUS):
+    start_loading(corpora[name])
+
+def memory_report():
+    return {
+        name: sources[os.path.abspath(fileName)].memory_report()
+        for name, fileName in corpora.items()
+        if os.path.abspath(fileName) in sources
+    }
 
 # Old output block
 #if __name__ == "__main__":
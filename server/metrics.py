@@ -0,0 +1,250 @@
+import time
+from bisect import bisect_left
+from collections import deque
+from server import markov
+from server.sharding import RemoteWorld
+
+# Instrumentation of the tick loop, served by the /metrics routes. Timings
+# and packet counts are only collected once enabled; until then the
+# instrumented code only checks metrics.enabled. Counts of worlds, entities,
+# clients and send queues are read when the metrics are asked for, so cost
+# nothing in between.
+#
+# Timings are kept per world, by phase:
+#   tick       the whole tick, as measured by the scheduler
+#   logic      the world's own tick logic, growing plants
+#   markov     sampling next words while growing
+#   diff       finding what each client sees and building its entries
+#              (entity fragments are encoded as they're first needed)
+#   serialize  splicing the entries into each client's update
+#   join       from a client's handshake to it being sent the world, including
+#              waiting its turn
+#   resume     the same, for clients resuming a session without being sent
+#              the world again
+
+# Upper bounds of the timing buckets, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+class Timing:
+	__slots__ = ('count', 'total', 'max', 'last', 'buckets')
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.last = 0.0
+		# One more for everything over the last bound
+		self.buckets = [0] * (len(BUCKETS) + 1)
+
+	def observe(self, seconds):
+		self.count += 1
+		self.total += seconds
+		self.last = seconds
+		if seconds > self.max:
+			self.max = seconds
+		self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+	def to_json(self):
+		return {
+			'count': self.count,
+			'total': self.total,
+			'mean': self.total / self.count if self.count else 0,
+			'max': self.max,
+			'last': self.last,
+		}
+
+class Metrics:
+	# Slow ticks remembered for /metrics.json
+	max_slow_ticks = 20
+
+	def __init__(self):
+		self.enabled = False
+		self.reset()
+
+	def reset(self):
+		self.started = time.time()
+		# Timings by (world id, phase)
+		self.timings = {}
+		# Packets and their bytes by (direction, packet type)
+		self.packets = {}
+		self.packet_bytes = {}
+		# Packets refused by (packet type, reason)
+		self.rejected = {}
+		self.slow_ticks = deque(maxlen=self.max_slow_ticks)
+
+	def observe(self, world_id, phase, seconds):
+		timing = self.timings.get((world_id, phase))
+		if timing is None:
+			timing = self.timings[world_id, phase] = Timing()
+		timing.observe(seconds)
+
+	# Once a world is unloaded
+	def forget_world(self, world_id):
+		for key in [key for key in self.timings if key[0] == world_id]:
+			del self.timings[key]
+
+	def count_packet(self, direction, name, size):
+		key = (direction, name)
+		self.packets[key] = self.packets.get(key, 0) + 1
+		self.packet_bytes[key] = self.packet_bytes.get(key, 0) + size
+
+	def count_rejected(self, name, reason):
+		key = (name, reason)
+		self.rejected[key] = self.rejected.get(key, 0) + 1
+
+	# Remembers an overrunning tick, with the time each phase took in it
+	def slow_tick(self, world, seconds):
+		self.slow_ticks.append({
+			'time': time.time(),
+			'world': world.id,
+			'tick': world.tick,
+			'seconds': seconds,
+			'phases': {
+				phase: timing.last
+				for (world_id, phase), timing in self.timings.items()
+				if world_id == world.id
+			},
+		})
+
+	def world_stats(self, world):
+		clients = list(world.clients.values())
+		return {
+			'tick': world.tick,
+			'tick_rate': world.tick_rate,
+			'tick_duration': world.tick_duration,
+			'tick_overruns': world.tick_overruns,
+			'tick_errors': world.tick_errors,
+			'hibernating': int(world.hibernating),
+			'skipped_ticks': world.skipped_ticks,
+			'entities': len(world.entities),
+			'static_entities': len(world.static_entities),
+			'plants': len(world.plants),
+			'clients': len(clients),
+			'clients_joining': sum(not c.ready for c in clients),
+			'clients_suspended': sum(c.suspended for c in clients),
+			'join_queue': sum(not future.done() for _, future in world.joining),
+			'queued_packets': sum(c.queue_depth for c in clients),
+			'queued_bytes': sum(c.queued_bytes for c in clients),
+			'max_queue_depth': max((c.max_queue_depth for c in clients), default=0),
+			'frames_sent': sum(c.frames_sent for c in clients),
+			'frames_coalesced': sum(c.frames_coalesced for c in clients),
+			'frames_dropped': sum(c.frames_dropped for c in clients),
+			'packets_rejected': sum(sum(c.rejected.values()) for c in clients),
+		}
+
+	def snapshot(self, universe):
+		worlds = {}
+		for world in universe.worlds.values():
+			if isinstance(world, RemoteWorld):
+				# Hosted by a worker process, which keeps its own metrics
+				worlds[world.id] = {'worker': world.worker.index}
+			else:
+				worlds[world.id] = self.world_stats(world)
+
+		for (world_id, phase), timing in self.timings.items():
+			if world_id in worlds:
+				worlds[world_id].setdefault('timings', {})[phase] = timing.to_json()
+
+		return {
+			'enabled': self.enabled,
+			'uptime': time.time() - self.started,
+			'clients': len(universe.clients),
+			'worlds': worlds,
+			'packets': [
+				{'direction': direction, 'type': name, 'count': count,
+					'bytes': self.packet_bytes[direction, name]}
+				for (direction, name), count in sorted(self.packets.items())
+			],
+			'rejected': [
+				{'type': name, 'reason': reason, 'count': count}
+				for (name, reason), count in sorted(self.rejected.items())
+			],
+			'slow_ticks': list(self.slow_ticks),
+			'markov': markov.memory_report(),
+		}
+
+	# The Prometheus text exposition format
+	def prometheus(self, universe):
+		lines = []
+		def metric(name, kind, help, samples):
+			lines.append(f'# HELP chatterbugs_{name} {help}')
+			lines.append(f'# TYPE chatterbugs_{name} {kind}')
+			for labels, value in samples:
+				label_text = ','.join(f'{k}="{escape(v)}"' for k, v in labels.items())
+				if label_text:
+					label_text = f'{{{label_text}}}'
+				lines.append(f'chatterbugs_{name}{label_text} {value}')
+
+		metric('clients', 'gauge', 'Connected clients.', [({}, len(universe.clients))])
+
+		stats = {
+			world.id: self.world_stats(world)
+			for world in universe.worlds.values()
+			if not isinstance(world, RemoteWorld)
+		}
+		for name, kind, help in WORLD_METRICS:
+			metric(f'world_{name}', kind, help, [
+				({'world': world_id}, world_stats[name])
+				for world_id, world_stats in stats.items()
+			])
+
+		lines.append('# HELP chatterbugs_phase_seconds Time spent in each phase of a tick.')
+		lines.append('# TYPE chatterbugs_phase_seconds histogram')
+		for (world_id, phase), timing in sorted(self.timings.items()):
+			labels = f'world="{escape(world_id)}",phase="{phase}"'
+			cumulative = 0
+			for bound, count in zip(BUCKETS, timing.buckets):
+				cumulative += count
+				lines.append(f'chatterbugs_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+			lines.append(f'chatterbugs_phase_seconds_bucket{{{labels},le="+Inf"}} {timing.count}')
+			lines.append(f'chatterbugs_phase_seconds_sum{{{labels}}} {timing.total}')
+			lines.append(f'chatterbugs_phase_seconds_count{{{labels}}} {timing.count}')
+
+		metric('packets_total', 'counter', 'Packets sent and received, by type.', [
+			({'direction': direction, 'type': name}, count)
+			for (direction, name), count in sorted(self.packets.items())
+		])
+		metric('packet_bytes_total', 'counter', 'Bytes of packets sent and received, by type.', [
+			({'direction': direction, 'type': name}, self.packet_bytes[direction, name])
+			for (direction, name) in sorted(self.packets)
+		])
+
+		metric('rejected_total', 'counter', 'Packets, or parts of them, refused by type and reason.', [
+			({'type': name, 'reason': reason}, count)
+			for (name, reason), count in sorted(self.rejected.items())
+		])
+
+		metric('markov_bytes', 'gauge', 'Memory used by each loaded Markov source.', [
+			({'corpus': name}, report['bytes'])
+			for name, report in markov.memory_report().items()
+		])
+		return '\n'.join(lines) + '\n'
+
+# Per-world stats exported to Prometheus
+WORLD_METRICS = [
+	('tick', 'counter', 'Ticks run.'),
+	('tick_duration', 'gauge', 'Seconds the last tick took.'),
+	('tick_overruns', 'counter', 'Ticks that took longer than their budget.'),
+	('tick_errors', 'counter', 'Ticks that raised an exception.'),
+	('hibernating', 'gauge', '1 if the world is empty and not ticking.'),
+	('skipped_ticks', 'counter', 'Ticks skipped to catch up.'),
+	('entities', 'gauge', 'Entities in the world.'),
+	('static_entities', 'gauge', 'Static entities in the world.'),
+	('plants', 'gauge', 'Plants in the world.'),
+	('clients', 'gauge', 'Clients in the world.'),
+	('clients_joining', 'gauge', 'Clients still being sent what they can see after joining.'),
+	('clients_suspended', 'gauge', 'Disconnected clients whose ants are kept for them to resume.'),
+	('join_queue', 'gauge', 'Clients waiting their turn to be let in.'),
+	('queued_packets', 'gauge', 'Packets waiting to be sent to clients.'),
+	('queued_bytes', 'gauge', 'Bytes waiting to be sent to clients.'),
+	('max_queue_depth', 'gauge', 'Deepest any client send queue has been.'),
+	('frames_sent', 'gauge', 'Packets sent to the clients in the world.'),
+	('frames_coalesced', 'gauge', 'World updates to the clients in the world replaced by a newer one before being sent.'),
+	('frames_dropped', 'gauge', 'Packets to the clients in the world dropped because a send buffer was full.'),
+	('packets_rejected', 'gauge', 'Packets, or parts of them, refused from the clients in the world.'),
+]
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
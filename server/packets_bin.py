@@ -0,0 +1,231 @@
+import struct
+from server.packets_json import Packet, names
+
+# Compact binary counterpart to packets_json. Values are tagged, floats are
+# sent as float32, common map keys are sent as small integers, and entities
+# are referred to by their world handle instead of their id once the client
+# has seen them. Must be kept in sync with static/js/packets-bin.js.
+#
+# Saves and journals reuse the value encoding with exact set, which keeps
+# floats as float64 under tags of their own. Those are never sent.
+
+NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, MAP, VEC2, ENTITIES, FLOAT64, VEC2_64 = range(12)
+
+KEYS = [
+	'type',
+	'pos',
+	'rot',
+	'text',
+	'scale',
+	'speech',
+	'gut',
+	'textActs',
+	'bellType',
+	'char',
+	'id',
+	'entities',
+	]
+
+key_indices = {key: i for i, key in enumerate(KEYS)}
+
+float32 = struct.Struct('<f')
+vec2 = struct.Struct('<ff')
+float64 = struct.Struct('<d')
+vec2_64 = struct.Struct('<dd')
+
+def write_varint(out, n):
+	while n > 0x7f:
+		out.append((n & 0x7f) | 0x80)
+		n >>= 7
+	out.append(n)
+
+def read_varint(data, i):
+	n = 0
+	shift = 0
+	while True:
+		b = data[i]
+		i += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return n, i
+		shift += 7
+
+def write_str(out, s):
+	encoded = s.encode('utf-8')
+	write_varint(out, len(encoded))
+	out += encoded
+
+def read_str(data, i):
+	n, i = read_varint(data, i)
+	return bytes(data[i:i + n]).decode('utf-8'), i + n
+
+def write_key(out, key):
+	index = key_indices.get(key)
+	if index is None:
+		encoded = key.encode('utf-8')
+		write_varint(out, len(KEYS) + len(encoded))
+		out += encoded
+	else:
+		write_varint(out, index)
+
+def read_key(data, i):
+	n, i = read_varint(data, i)
+	if n < len(KEYS):
+		return KEYS[n], i
+	n -= len(KEYS)
+	return bytes(data[i:i + n]).decode('utf-8'), i + n
+
+def is_number(value):
+	return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def write_value(out, value, exact=False):
+	if value is None:
+		out.append(NONE)
+	elif value is False:
+		out.append(FALSE)
+	elif value is True:
+		out.append(TRUE)
+	elif isinstance(value, int):
+		out.append(INT)
+		write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+	elif isinstance(value, float):
+		if exact:
+			out.append(FLOAT64)
+			out += float64.pack(value)
+		else:
+			out.append(FLOAT)
+			out += float32.pack(value)
+	elif isinstance(value, str):
+		out.append(STR)
+		write_str(out, value)
+	elif isinstance(value, dict):
+		out.append(MAP)
+		write_varint(out, len(value))
+		for key, item in value.items():
+			write_key(out, key)
+			write_value(out, item, exact)
+	elif isinstance(value, (list, tuple)):
+		if len(value) == 2 and is_number(value[0]) and is_number(value[1]):
+			if exact:
+				out.append(VEC2_64)
+				out += vec2_64.pack(*value)
+			else:
+				out.append(VEC2)
+				out += vec2.pack(*value)
+		else:
+			out.append(LIST)
+			write_varint(out, len(value))
+			for item in value:
+				write_value(out, item, exact)
+	else:
+		raise TypeError(f'Cannot encode {type(value).__name__}')
+
+def read_value(data, i):
+	tag = data[i]
+	i += 1
+	
+	if tag == NONE:
+		return None, i
+	elif tag == FALSE:
+		return False, i
+	elif tag == TRUE:
+		return True, i
+	elif tag == INT:
+		n, i = read_varint(data, i)
+		return (-((n + 1) >> 1) if n & 1 else n >> 1), i
+	elif tag == FLOAT:
+		return float32.unpack_from(data, i)[0], i + 4
+	elif tag == FLOAT64:
+		return float64.unpack_from(data, i)[0], i + 8
+	elif tag == STR:
+		return read_str(data, i)
+	elif tag == VEC2:
+		return list(vec2.unpack_from(data, i)), i + 8
+	elif tag == VEC2_64:
+		return list(vec2_64.unpack_from(data, i)), i + 16
+	elif tag == LIST:
+		n, i = read_varint(data, i)
+		items = []
+		for _ in range(n):
+			item, i = read_value(data, i)
+			items.append(item)
+		return items, i
+	elif tag == MAP:
+		n, i = read_varint(data, i)
+		items = {}
+		for _ in range(n):
+			key, i = read_key(data, i)
+			items[key], i = read_value(data, i)
+		return items, i
+	else:
+		raise ValueError(f'Invalid value tag {tag}')
+
+class PacketType:
+	def __init__(self, name, index):
+		self.name = name
+		self.index = index
+	
+	def __call__(self, **kwargs):
+		out = bytearray()
+		write_varint(out, self.index)
+		write_value(out, kwargs)
+		return bytes(out)
+	
+	# Build a packet from maps of entities already encoded by a FragmentCache
+	def splice(self, **maps):
+		out = bytearray()
+		write_varint(out, self.index)
+		out.append(MAP)
+		write_varint(out, len(maps))
+		for name, entries in maps.items():
+			write_key(out, name)
+			out.append(ENTITIES)
+			write_varint(out, len(entries))
+			for entry in entries:
+				out += entry
+		return bytes(out)
+
+# Entity entries start with the entity's handle. Full snapshots ('data')
+# also carry the entity's id, which the client remembers for later entries.
+class FragmentCache:
+	def __init__(self):
+		self.fragments = {}
+	
+	def entry(self, entity, kind, value):
+		key = (entity.handle, kind)
+		try:
+			return self.fragments[key]
+		except KeyError:
+			out = bytearray()
+			if kind == 'data':
+				write_varint(out, entity.handle << 1 | 1)
+				write_str(out, entity.id)
+			else:
+				write_varint(out, entity.handle << 1)
+			write_value(out, value)
+			fragment = self.fragments[key] = bytes(out)
+			return fragment
+
+def unpack(client, data):
+	if isinstance(data, str):
+		raise ValueError('Expected a binary packet')
+	
+	index, i = read_varint(data, 0)
+	try:
+		ptype = type_list[index]
+	except IndexError:
+		raise ValueError(f'Invalid packet type {index}')
+	
+	fields, i = read_value(data, i)
+	if not isinstance(fields, dict):
+		raise ValueError('Packet body must be a map')
+	return Packet(ptype, **fields)
+
+types = {}
+type_list = []
+
+for index, name in enumerate(names):
+	packet = PacketType(name, index)
+	types[name] = packet
+	type_list.append(packet)
+	globals().setdefault(name, packet)
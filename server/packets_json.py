@@ -1,3 +1,6 @@
+# Human-readable protocol, handy for debugging. See packets_bin for the
+# compact one.
+
 import json
 
 class PacketType:
@@ -6,6 +9,31 @@ class PacketType:
 	
 	def __call__(self, **kwargs):
 		return json.dumps({**kwargs, '_type': self.name})
+	
+	# Build a packet from maps whose entries are already encoded,
+	# e.g. by a FragmentCache.
+	def splice(self, **maps):
+		parts = [
+			f'{json.dumps(name)}:{{{",".join(entries)}}}'
+			for name, entries in maps.items()
+		]
+		parts.append(f'"_type":{json.dumps(self.name)}')
+		return '{' + ','.join(parts) + '}'
+
+# Encodes each (entity, kind) map entry once, so the same entity can be
+# spliced into many clients' packets without re-encoding it.
+class FragmentCache:
+	def __init__(self):
+		self.fragments = {}
+	
+	def entry(self, entity, kind, value):
+		key = (entity.id, kind)
+		try:
+			return self.fragments[key]
+		except KeyError:
+			fragment = f'{json.dumps(entity.id)}:{json.dumps(value)}'
+			self.fragments[key] = fragment
+			return fragment
 
 class Packet:
 	def __init__(self, ptype, **kwargs):
@@ -24,7 +52,7 @@ def unpack(client, data):
 
 types = {}
 
-for name in [
+names = [
 	'S_OpenWorld',
 	'S_CloseWorld',
 	'S_UpdateWorld',
@@ -32,7 +60,9 @@ for name in [
 	'C_MakeBox',
 	'C_MakePlant',
 	'C_Destroy',
-	]:
+	]
+
+for name in names:
 	packet = PacketType(name)
 	types[name] = packet
 	globals().setdefault(name, packet)
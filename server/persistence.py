@@ -0,0 +1,267 @@
+import asyncio
+import mmap
+import os
+import struct
+from urllib.parse import quote
+from server.packets_bin import write_varint, read_varint, write_value, read_value
+from server.entity import Point
+from server.box import Box
+from server.plant import Plant, Word
+from server.terrblock import TerrBlock
+from server.sharding import RemoteWorld
+
+# Saves each world as a snapshot plus a log of what changed since, so a
+# periodic save only writes the entities that changed. Both files are a
+# sequence of records using the binary packet encoding, with exact floats:
+#   upsert: UPSERT, handle, data map, links list
+#   remove: REMOVE, handle
+#   next handle: NEXT_HANDLE, handle
+# An upsert carries an entity's whole state, so replaying a record twice
+# does no harm, and a record cut short by a crash is ignored.
+
+MAGIC = b'CBW1'
+UPSERT, REMOVE, NEXT_HANDLE = range(3)
+
+# Players' ants aren't saved; they come back when the player does
+saved_types = {cls.type_id: cls for cls in (Box, Plant, TerrBlock, Word)}
+
+def handle_of(entity):
+	return entity.handle if entity is not None and entity.world else None
+
+# State that isn't in an entity's data: which plant and branch a word grew
+# from, and the corpus a plant grows from
+def entity_links(entity):
+	if isinstance(entity, Word):
+		return [
+			handle_of(entity.parent_plant),
+			handle_of(entity.parent_branch),
+			entity.parent_word,
+			entity.rejected,
+		]
+	elif isinstance(entity, Plant):
+		return [entity.corpus]
+	return []
+
+def build_entity(data, links, restored):
+	pos = Point(*data['pos'])
+	rot = data['rot']
+	t = data['type']
+	if t == 'box':
+		return Box(pos, rot, data.get('text'))
+	elif t == 'terrblock':
+		return TerrBlock(pos, Point(*data['scale']), rot)
+	elif t == 'plant':
+		return Plant(pos, rot, data.get('text'), links[0])
+	elif t == 'word':
+		plant_handle, branch_handle, parent_word, rejected = links
+		plant = restored.get(plant_handle)
+		branch = restored.get(branch_handle)
+		# Words cut off from their plant (or grown from a removed word) are
+		# dead, as they were when their branch was removed
+		if branch_handle is not None and (branch is None or not branch.alive):
+			plant = None
+		word = Word(pos, rot, data.get('text'), plant, branch)
+		word.parent_word = parent_word
+		word.rejected = rejected
+		if plant is not None:
+			plant.words.append(word)
+		# Dead words stay on their branch, as removing them takes them off it
+		if branch is not None:
+			branch.branches.append(word)
+		return word
+	raise ValueError(f'Cannot restore entity type {t}')
+
+# Replaces a world's entities with states, (data, links) by handle, as
+# though they had been there all along. Must be called before any clients
+# join.
+def restore_entities(world, states, next_handle):
+	for entity in list(world.entities.values()):
+		world.remove_entity(entity)
+
+	# Handles only grow, so parents are restored before their words
+	restored = {}
+	for handle in sorted(states):
+		data, links = states[handle]
+		entity = build_entity(data, links, restored)
+		for key, value in data.items():
+			if key not in entity.data:
+				entity.data[key] = value
+		world.add_entity(entity, handle)
+		restored[handle] = entity
+	world.next_handle = max(world.next_handle, next_handle)
+	world.unsaved.clear()
+	world.unsaved_removed.clear()
+
+def encode_records(records):
+	out = bytearray()
+	for record in records:
+		out.append(record[0])
+		write_varint(out, record[1])
+		if record[0] == UPSERT:
+			write_value(out, record[2], exact=True)
+			write_value(out, record[3], exact=True)
+	return out
+
+def read_records(fileName, states, next_handle):
+	try:
+		with open(fileName, 'rb') as f:
+			if os.fstat(f.fileno()).st_size <= len(MAGIC):
+				return next_handle
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except FileNotFoundError:
+		return next_handle
+
+	with data:
+		if data[:len(MAGIC)] != MAGIC:
+			raise ValueError(f'{fileName} is not a saved world')
+		i = len(MAGIC)
+		try:
+			while i < len(data):
+				kind = data[i]
+				handle, i = read_varint(data, i + 1)
+				if kind == UPSERT:
+					state, i = read_value(data, i)
+					links, i = read_value(data, i)
+					states[handle] = (state, links)
+				elif kind == REMOVE:
+					states.pop(handle, None)
+				elif kind == NEXT_HANDLE:
+					next_handle = max(next_handle, handle)
+				else:
+					raise ValueError(f'Invalid record {kind}')
+		except (IndexError, ValueError, struct.error):
+			print('Ignoring the end of', fileName, 'from byte', i)
+	return next_handle
+
+def write_snapshot(snapshot_name, log_name, records):
+	tempName = f'{snapshot_name}.{os.getpid()}.tmp'
+	with open(tempName, 'wb') as f:
+		f.write(MAGIC)
+		f.write(encode_records(records))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tempName, snapshot_name)
+	# Everything in the log is in the new snapshot
+	try:
+		os.remove(log_name)
+	except FileNotFoundError:
+		pass
+	return os.path.getsize(snapshot_name)
+
+def append_log(log_name, records):
+	with open(log_name, 'ab') as f:
+		if f.tell() == 0:
+			f.write(MAGIC)
+		f.write(encode_records(records))
+		f.flush()
+		os.fsync(f.fileno())
+		return f.tell()
+
+class WorldStore:
+	def __init__(self, directory, interval=30, compact_ratio=1.0):
+		self.directory = directory
+		# Seconds between saves
+		self.interval = interval
+		# A new snapshot is written once the log outgrows this much of it
+		self.compact_ratio = compact_ratio
+		self.snapshot_sizes = {}
+		self.log_sizes = {}
+		# Saves of the same world must not interleave
+		self.lock = asyncio.Lock()
+		os.makedirs(directory, exist_ok=True)
+
+	def paths(self, world_id):
+		base = os.path.join(self.directory, quote(world_id, safe=''))
+		return f'{base}.world', f'{base}.log'
+
+	def exists(self, world_id):
+		return os.path.exists(self.paths(world_id)[0])
+
+	# Replaces a world's entities with the saved ones. Must be called before
+	# any clients join.
+	def restore(self, world):
+		snapshot_name, log_name = self.paths(world.id)
+		states = {}
+		next_handle = read_records(snapshot_name, states, 0)
+		next_handle = read_records(log_name, states, next_handle)
+		if not states and next_handle == 0:
+			return False
+
+		restore_entities(world, states, next_handle)
+		if os.path.exists(snapshot_name):
+			self.snapshot_sizes[world.id] = os.path.getsize(snapshot_name)
+		if os.path.exists(log_name):
+			self.log_sizes[world.id] = os.path.getsize(log_name)
+		return True
+
+	# Taken on the event loop so the state is consistent; encoding and
+	# writing happen on a thread
+	def capture(self, entity):
+		return (UPSERT, entity.handle, dict(entity.data), entity_links(entity))
+
+	async def save(self, world, full=False):
+		async with self.lock:
+			await self._save(world, full)
+
+	async def _save(self, world, full):
+		snapshot_name, log_name = self.paths(world.id)
+		loop = asyncio.get_running_loop()
+
+		snapshot_size = self.snapshot_sizes.get(world.id)
+		log_size = self.log_sizes.get(world.id, 0)
+		if snapshot_size is None or log_size > snapshot_size * self.compact_ratio:
+			full = True
+
+		if full:
+			records = [
+				self.capture(e) for e in world.entities.values()
+				if saved_types.get(e.data['type']) is type(e)
+			]
+		else:
+			if not world.unsaved and not world.unsaved_removed:
+				return
+			records = [(REMOVE, handle) for handle in world.unsaved_removed]
+			records += [
+				self.capture(e) for e in world.unsaved
+				if e.world is world and saved_types.get(e.data['type']) is type(e)
+			]
+		records.append((NEXT_HANDLE, world.next_handle))
+		# Replays only need the journal from here on
+		world.record('saved', None, {
+			'full': full,
+			'clients': {
+				face: client.entity.handle
+				for face, client in world.clients.items()
+			},
+		})
+		# Changes from here on go in the next save
+		unsaved, world.unsaved = world.unsaved, set()
+		unsaved_removed, world.unsaved_removed = world.unsaved_removed, set()
+
+		try:
+			if full:
+				self.snapshot_sizes[world.id] = await loop.run_in_executor(
+					None, write_snapshot, snapshot_name, log_name, records)
+				self.log_sizes[world.id] = 0
+			else:
+				self.log_sizes[world.id] = await loop.run_in_executor(
+					None, append_log, log_name, records)
+		except BaseException:
+			# Saved next time instead
+			world.unsaved |= {e for e in unsaved if e.world is world}
+			world.unsaved_removed |= unsaved_removed
+			world.record('save_failed')
+			raise
+
+	async def save_all(self, universe):
+		for world in list(universe.worlds.values()):
+			if not isinstance(world, RemoteWorld):
+				try:
+					await self.save(world)
+				except Exception as e:
+					print('Could not save world', world.id, e)
+
+	async def run(self, universe):
+		while True:
+			await asyncio.sleep(self.interval)
+			await self.save_all(universe)
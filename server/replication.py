@@ -0,0 +1,76 @@
+from server.entity import Point, dirty_bit
+
+# Movement replication for entities that move every tick (ants). Positions
+# and rotations are rounded before they're sent, changes smaller than a
+# threshold are held back while the entity is moving, and entities far from
+# a client are only updated every few ticks. Each client remembers the
+# movement it has acknowledged receiving (see WSClient.acknowledge), and is
+# sent changes against that, so skipped or dropped updates lose nothing: the
+# next one carries the latest state, and a stopped entity always settles at
+# its exact position.
+
+MOVEMENT_BITS = dirty_bit('pos') | dirty_bit('rot')
+
+class MovementReplicator:
+	def __init__(self, *,
+		pos_digits=1, rot_digits=3,
+		pos_threshold=0.5, rot_threshold=0.01,
+		near_radius=400, far_interval=3):
+		
+		self.pos_digits = pos_digits
+		self.rot_digits = rot_digits
+		self.pos_threshold = pos_threshold
+		self.rot_threshold = rot_threshold
+		self.near_radius = near_radius
+		self.far_interval = far_interval
+		# Quantized movement this tick, by entity, shared between clients
+		self.quantized = {}
+	
+	# Called before each tick's updates, as entities may have moved
+	def start_tick(self):
+		self.quantized.clear()
+	
+	def quantize(self, entity):
+		x, y = entity.pos
+		return (
+			Point(round(x, self.pos_digits), round(y, self.pos_digits)),
+			round(entity.rot, self.rot_digits))
+	
+	# moved collects the movement an update carries, for the client to take
+	# on once it's acknowledged
+	def sent_full(self, entity, moved):
+		moved[entity] = self.quantize(entity)
+	
+	def is_far(self, client, entity):
+		cx, cy = client.entity.pos
+		x, y = entity.pos
+		sqr_distance = (x - cx) * (x - cx) + (y - cy) * (y - cy)
+		return sqr_distance > self.near_radius * self.near_radius
+	
+	def update(self, client, entity, tick, moved):
+		if (tick + entity.handle) % self.far_interval and self.is_far(client, entity):
+			return {}
+		
+		state = self.quantized.get(entity)
+		if state is None:
+			state = self.quantized[entity] = self.quantize(entity)
+		last = client.sent_movement[entity]
+		if state == last:
+			return {}
+		pos, rot = state
+		last_pos, last_rot = last
+		moving = entity.dirty & MOVEMENT_BITS
+		
+		movement = {}
+		if pos != last_pos:
+			dx = pos[0] - last_pos[0]
+			dy = pos[1] - last_pos[1]
+			if not moving or dx * dx + dy * dy >= self.pos_threshold ** 2:
+				movement['pos'] = last_pos = pos
+		if rot != last_rot and (not moving
+				or abs(rot - last_rot) >= self.rot_threshold):
+			movement['rot'] = last_rot = rot
+		
+		if movement:
+			moved[entity] = (last_pos, last_rot)
+		return movement
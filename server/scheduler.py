@@ -0,0 +1,89 @@
+import asyncio
+import heapq
+import time
+import traceback
+from server.metrics import metrics
+
+# Ticks each world on its own absolute timeline, so slow ticks don't stretch
+# the interval between them. Worlds are spread across the tick interval
+# instead of all running back to back, and a world that falls too far behind
+# skips the ticks it missed rather than running them all at once.
+
+class TickScheduler:
+	def __init__(self, max_catch_up=3):
+		self.max_catch_up = max_catch_up
+		# Heap of (due time, sequence number, world), and the sequence number
+		# of each scheduled world's current entry. Entries of worlds that
+		# were removed are left in the heap, and skipped once they come up.
+		self.heap = []
+		self.due = {}
+		self.seq = 0
+		self.added = 0
+	
+	def add(self, world):
+		interval = 1 / world.tick_rate
+		# Golden ratio offsets stay evenly spread however many worlds there are
+		phase = (self.added * 0.618033988749895) % 1
+		self.added += 1
+		self.schedule(world, time.monotonic() + phase * interval)
+	
+	def schedule(self, world, due):
+		self.seq += 1
+		self.due[world] = self.seq
+		heapq.heappush(self.heap, (due, self.seq, world))
+	
+	def remove(self, world):
+		return self.due.pop(world, None) is not None
+	
+	def tick(self, world):
+		start = time.perf_counter()
+		try:
+			world.broadcast_tick()
+		except Exception:
+			print('Exception while ticking world', world.id)
+			traceback.print_exc()
+			world.tick_errors += 1
+		duration = time.perf_counter() - start
+		
+		world.tick_duration = duration
+		if metrics.enabled:
+			metrics.observe(world.id, 'tick', duration)
+		if duration > world.tick_budget:
+			world.tick_overruns += 1
+			if metrics.enabled:
+				metrics.slow_tick(world, duration)
+	
+	async def run(self):
+		heap = self.heap
+		while True:
+			while heap and self.due.get(heap[0][2]) != heap[0][1]:
+				heapq.heappop(heap)
+			if not heap:
+				await asyncio.sleep(0.1)
+				continue
+			
+			due, seq, world = heap[0]
+			delay = due - time.monotonic()
+			if delay > 0:
+				# Worlds may have been added or removed while sleeping
+				await asyncio.sleep(delay)
+				continue
+			
+			heapq.heappop(heap)
+			self.tick(world)
+			
+			# Removed, or removed and added again, while ticking
+			if self.due.get(world) != seq:
+				continue
+			
+			interval = 1 / world.tick_rate
+			due += interval
+			behind = time.monotonic() - due
+			if behind > interval * self.max_catch_up:
+				skipped = int(behind // interval)
+				world.skipped_ticks += skipped
+				due += skipped * interval
+			self.schedule(world, due)
+			
+			# Let client messages through between ticks
+			await asyncio.sleep(0)
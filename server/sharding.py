@@ -0,0 +1,150 @@
+import asyncio
+import multiprocessing
+from urllib.parse import parse_qs, quote, urlsplit
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+# Hosts worlds in worker processes, so a server can use more than one core.
+# Each worker runs its own universe and serves it as a websocket on the
+# loopback interface; the front process keeps track of which worker owns
+# which world and proxies client connections for that world to it. Workers
+# report the worlds they unload, so the front process can forget them.
+
+class RemoteWorld:
+	def __init__(self, id, worker):
+		self.id = id
+		self.worker = worker
+		self.universe = None
+		# Connections being proxied to it
+		self.connections = 0
+
+class Worker:
+	# Worlds are saved to save_dir and journaled to journal_dir, if given
+	def __init__(self, index, save_dir=None, journal_dir=None):
+		self.index = index
+		self.port = None
+		# Ids of the worlds it has loaded, as far as the front process knows
+		self.worlds = set()
+		self.conn, child_conn = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(
+			target=worker_main, args=(child_conn, save_dir, journal_dir),
+			name=f'chatterbugs-worker-{index}', daemon=True)
+	
+	def start(self):
+		self.process.start()
+		# The worker reports the port it bound once it's ready
+		self.port = self.conn.recv()
+	
+	# The worker saves its worlds before exiting, which join waits for
+	def stop(self):
+		if self.process.is_alive():
+			self.conn.send(('stop',))
+	
+	def join(self, timeout=30):
+		self.process.join(timeout)
+	
+	def create_world(self, world_id):
+		self.conn.send(('create_world', world_id))
+		self.worlds.add(world_id)
+	
+	# Passes a client's connection through to the worker, noting the session
+	# the worker gives it
+	async def proxy(self, client, world_id, codec, session=None, received=None):
+		ws = client.ws
+		uri = (f'ws://127.0.0.1:{self.port}/connect'
+			f'?world={quote(world_id)}&codec={quote(codec)}')
+		if session:
+			uri += f'&session={quote(session)}'
+		if received is not None:
+			uri += f'&received={received}'
+		
+		async with websockets.connect(uri, max_size=None) as upstream:
+			await upstream.send(client.face)
+			
+			try:
+				reply = await upstream.recv()
+			except ConnectionClosed:
+				return
+			result, _, token = reply.partition(':')
+			if result in ('success', 'resumed'):
+				client.session = token
+			await ws.send(reply)
+			
+			pumps = [
+				asyncio.ensure_future(pump(ws, upstream)),
+				asyncio.ensure_future(pump(upstream, ws)),
+			]
+			_, pending = await asyncio.wait(
+				pumps, return_when=asyncio.FIRST_COMPLETED)
+			for task in pending:
+				task.cancel()
+
+async def pump(source, dest):
+	try:
+		while True:
+			await dest.send(await source.recv())
+	except ConnectionClosed:
+		pass
+
+def worker_main(conn, save_dir=None, journal_dir=None):
+	asyncio.run(run_worker(conn, save_dir, journal_dir))
+
+async def run_worker(conn, save_dir=None, journal_dir=None):
+	from server.clients import WSClient, codecs
+	from server.limits import is_face
+	from server.world import ChatterUniverse
+	
+	universe = ChatterUniverse(default_world=False)
+	universe.on_unloaded = lambda world: conn.send(('unloaded', world.id))
+	if save_dir:
+		universe.enable_saving(save_dir)
+	if journal_dir:
+		universe.enable_journal(journal_dir)
+	loop = asyncio.get_running_loop()
+	stopped = loop.create_future()
+	
+	def on_command():
+		while conn.poll():
+			command, *args = conn.recv()
+			if command == 'create_world':
+				# A client may have got here first and had it made. It's turned
+				# away if the worker is full of worlds in use.
+				if universe.open_world(args[0]) is None:
+					conn.send(('unloaded', args[0]))
+			elif command == 'stop' and not stopped.done():
+				stopped.set_result(None)
+	
+	async def on_connect(ws, path):
+		args = parse_qs(urlsplit(path).query)
+		# The world may have been unloaded since the front process made it
+		world = universe.open_world(args.get('world', [''])[0])
+		codec = codecs.get(args.get('codec', ['json'])[0])
+		session = args.get('session', [None])[0]
+		received = args.get('received', [''])[0]
+		received = int(received) if received.isdigit() else None
+		face = await ws.recv()
+		
+		if not world or not codec:
+			await ws.send('invalid_world')
+			return
+		if not is_face(face):
+			await ws.send('invalid_face')
+			return
+		
+		client = WSClient(ws, face, codec)
+		try:
+			async with universe.add_client(client, world, session, received) as client:
+				await client.run()
+		except (ConnectionClosed, KeyError, RuntimeError):
+			pass
+	
+	loop.add_reader(conn.fileno(), on_command)
+	server = await websockets.serve(on_connect, '127.0.0.1', 0, max_size=None)
+	conn.send(server.sockets[0].getsockname()[1])
+	
+	ticking = asyncio.ensure_future(universe.run())
+	await stopped
+	ticking.cancel()
+	await universe.close()
+	server.close()
+	await server.wait_closed()
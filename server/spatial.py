@@ -0,0 +1,112 @@
+import math
+from collections import defaultdict
+
+def aabb_intersects(a, b):
+	return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def aabb_sqr_distance(aabb, point):
+	x, y = point
+	dx = max(aabb[0] - x, 0, x - aabb[2])
+	dy = max(aabb[1] - y, 0, y - aabb[3])
+	return dx * dx + dy * dy
+
+# Separating axis test between two (center, rotation, half width, half
+# height) boxes
+def obb_intersects(a, b):
+	(ax, ay), arot, aw, ah = a
+	(bx, by), brot, bw, bh = b
+	dx = bx - ax
+	dy = by - ay
+	ac, as_ = math.cos(arot), math.sin(arot)
+	bc, bs = math.cos(brot), math.sin(brot)
+	for cx, cy in ((ac, as_), (-as_, ac), (bc, bs), (-bs, bc)):
+		ra = aw * abs(ac * cx + as_ * cy) + ah * abs(-as_ * cx + ac * cy)
+		rb = bw * abs(bc * cx + bs * cy) + bh * abs(-bs * cx + bc * cy)
+		if abs(dx * cx + dy * cy) > ra + rb:
+			return False
+	return True
+
+def radius_aabb(center, radius):
+	x, y = center
+	return (x - radius, y - radius, x + radius, y + radius)
+
+# Uniform grid for entities that move every tick. Moving an entity only
+# touches the grid when it crosses a cell boundary, which is much cheaper
+# than re-inserting it into an R-tree. Entities' aabbs are brought up to
+# date as they're inserted and updated.
+class SpatialGrid:
+	def __init__(self, cell_size=256):
+		self.cell_size = cell_size
+		self.cells = defaultdict(set)
+		self.entity_cells = {}
+	
+	def __len__(self):
+		return len(self.entity_cells)
+	
+	def __iter__(self):
+		return iter(self.entity_cells)
+	
+	def __contains__(self, entity):
+		return entity in self.entity_cells
+	
+	def _cell_range(self, aabb):
+		size = self.cell_size
+		return (
+			math.floor(aabb[0] / size), math.floor(aabb[1] / size),
+			math.floor(aabb[2] / size), math.floor(aabb[3] / size))
+	
+	@staticmethod
+	def _cell_keys(cell_range):
+		x0, y0, x1, y1 = cell_range
+		for cx in range(x0, x1 + 1):
+			for cy in range(y0, y1 + 1):
+				yield (cx, cy)
+	
+	def insert(self, entity):
+		if entity in self.entity_cells:
+			raise KeyError(f'{entity.id} is already in the grid')
+		
+		entity.aabb = entity.get_aabb()
+		cell_range = self._cell_range(entity.aabb)
+		self.entity_cells[entity] = cell_range
+		for key in self._cell_keys(cell_range):
+			self.cells[key].add(entity)
+	
+	def remove(self, entity):
+		cell_range = self.entity_cells.pop(entity, None)
+		if cell_range is None:
+			return False
+		
+		for key in self._cell_keys(cell_range):
+			cell = self.cells[key]
+			cell.discard(entity)
+			if not cell:
+				del self.cells[key]
+		return True
+	
+	def update(self, entity):
+		entity.aabb = entity.get_aabb()
+		cell_range = self._cell_range(entity.aabb)
+		if self.entity_cells.get(entity) != cell_range:
+			self.remove(entity)
+			self.insert(entity)
+	
+	def update_all(self):
+		for entity in list(self.entity_cells):
+			self.update(entity)
+	
+	def query(self, aabb):
+		cell_range = self._cell_range(aabb)
+		x0, y0, x1, y1 = cell_range
+		
+		# Huge queries are cheaper to answer by walking the occupied cells
+		if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+			candidates = self.entity_cells
+		else:
+			candidates = set()
+			for key in self._cell_keys(cell_range):
+				candidates.update(self.cells.get(key, ()))
+		
+		for entity in candidates:
+			if aabb_intersects(entity.aabb, aabb):
+				yield entity
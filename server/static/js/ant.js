@@ -1,6 +1,5 @@
 import Vec2 from './vec2.js';
 import Entity from './entity.js';
-import Packets from './packets-json.js';
 import Word from './word.js';
 import { TAU, PI_2, lerpAngle, normalizeAngle, nearestPointOnSegment, peek, removeItem } from './utils.js';
 
@@ -39,7 +38,8 @@ const antNetAppliers = {
 		for (const act of acts) {
 			switch (act.type) {
 			case 'eat':
-				this.eatChar(act.char, Vec2.fromIter(act.pos), act.rot);
+				// Acts without a valid position are sent without one
+				this.eatChar(act.char, act.pos && Vec2.fromIter(act.pos), act.rot);
 				break;
 			case 'speak':
 				this.speakChar(act.char);
@@ -763,7 +763,7 @@ export class PlayerAnt extends Ant {
 					this.unspeakAll();
 				} else {
 					engine.socket.send(
-						Packets.C_MakeBox.unparse({
+						engine.packets.C_MakeBox.unparse({
 							pos: this.pos,
 							rot: this.rot,
 							text: text,
@@ -776,7 +776,7 @@ export class PlayerAnt extends Ant {
 					this.unspeakAll();
 				} else {
 					engine.socket.send(
-						Packets.C_MakePlant.unparse({
+						engine.packets.C_MakePlant.unparse({
 							pos: this.pos,
 							rot: this.rot,
 							text: text,
@@ -899,7 +899,7 @@ export class PlayerAnt extends Ant {
 				}
 			}
 			if (target) {
-				engine.socket.send(Packets.C_Destroy.unparse({id: target.id}));
+				engine.socket.send(engine.packets.C_Destroy.unparse({id: target.id}));
 				target.disabled = true;
 				for (let i = target.text.length-1; i >= 0; i--) {
 					const charX = i * charWidth - (target.text.length*charWidth)/2 + charSubWidth / 2;
@@ -913,7 +913,7 @@ export class PlayerAnt extends Ant {
 		this.secsSinceNet += dt;
 		if (this.secsSinceNet > 0.03 && this.broadcastDiff) {
 			engine.socket.send(
-				Packets.C_UpdateSelf.unparse(this.broadcastDiff));
+				engine.packets.C_UpdateSelf.unparse(this.broadcastDiff));
 			this.secsSinceNet = 0;
 			this.broadcastDiff = null;
 		}
@@ -61,10 +61,13 @@ export class InputEvent extends EngineEvent {
 
 export default class Engine {
 	
-	constructor(canvas, socket, entityTypes) {
+	constructor(canvas, socket, entityTypes, packets=Packets) {
 		this.canvas = canvas;
 		this.ctx = canvas.getContext('2d');
 		this.socket = socket;
+		this.packets = packets;
+		// World updates received since the world was last opened
+		this.updatesReceived = 0;
 		this.entityTypes = entityTypes;
 		this.audio = new GameAudio();
 		
@@ -223,11 +226,13 @@ export default class Engine {
 	
 	async _handlePacket() {
 		const mess = await this.socket.recv();
+		const Packets = this.packets;
 		const p = Packets.parse(mess.data);
 		
 		switch (p._type) {
 			case Packets.S_OpenWorld: {
 				this.killAllEntities();
+				this.updatesReceived = 0;
 				
 				for (const id in p.entities) {
 					this.addEntityFromData(id, p.entities[id]);
@@ -235,21 +240,21 @@ export default class Engine {
 				break;
 			}
 			case Packets.S_UpdateWorld: {
-				for (const [id, ent] of this.entities) {
-					
+				// Counted so a resumed session can carry on from here
+				this.updatesReceived++;
+				// Entities left out haven't changed; null means removed
+				for (const id in p.entities) {
 					const diff = p.entities[id];
-					if (!diff || ent.isDead) {
+					const ent = this.entities.get(id);
+					
+					if (diff === null) {
 						// TODO: onDead callback?
 						this.entities.delete(id);
-						continue;
+					} else if (ent && !ent.isDead) {
+						ent.dispatchEvent(new DiffEvent(this, diff));
+					} else {
+						this.addEntityFromData(id, diff);
 					}
-					
-					delete p.entities[id];
-					ent.dispatchEvent(new DiffEvent(this, diff));
-				}
-				
-				for (const id in p.entities) {
-					this.addEntityFromData(id, p.entities[id]);
 				}
 				
 				break;
@@ -1,4 +1,6 @@
 import Socket from './socket.js';
+import JSONPackets from './packets-json.js';
+import BinPackets from './packets-bin.js';
 import { EntityTypeRegistry } from './entity.js';
 import Engine from './engine.js';
 import Ant from './ant.js';
@@ -12,11 +14,48 @@ const faceInput = document.getElementById('face-input');
 const connectForm = document.getElementById('connect');
 const connectButton = document.getElementById('connect-button');
 
+// Add ?codec=json to the page URL to use the readable protocol
+const codec = new URL(location).searchParams.get('codec') || 'bin';
+const packets = (codec === 'json') ? JSONPackets : BinPackets;
+
 const wsConnectUrl = new URL('connect', location);
 wsConnectUrl.protocol = 'ws:';
+wsConnectUrl.searchParams.set('codec', codec);
+// Add ?world=name to the page URL to play in a world of your own
+const world = new URL(location).searchParams.get('world');
+if (world) {
+	wsConnectUrl.searchParams.set('world', world);
+}
 
 connectForm.addEventListener('submit', runGame);
 
+// Kept for the rest of the tab's life, so reloading the page takes back the
+// same ant if the server still has it
+function sessionKey(face) {
+	return `session:${world || 'default'}:${face}`;
+}
+
+// Resolves to the socket and the server's reply. Passing how many world
+// updates were received lets the server carry on from there, instead of
+// sending the whole world again.
+async function connect(face, session=null, received=null) {
+	const url = new URL(wsConnectUrl);
+	if (session) {
+		url.searchParams.set('session', session);
+		if (received !== null) {
+			url.searchParams.set('received', received);
+		}
+	}
+	
+	const socket = new Socket(url);
+	// Fails if the server can't be reached, where sending would wait forever
+	await socket.opened();
+	await socket.send(face);
+	const reply = (await socket.recv()).data;
+	const [result, newSession = null] = reply.split(':');
+	return {socket, result, session: newSession};
+}
+
 async function runGame() {
 	const playerFace = faceInput.value;
 	
@@ -28,33 +67,42 @@ async function runGame() {
 	faceInput.disabled = true;
 	connectButton.disabled = true;
 	
-	const socket = new Socket(wsConnectUrl);
-	
-	await socket.send(playerFace);
-	const connectionResult = await socket.recv();
+	let {socket, result, session} = await connect(
+		playerFace, sessionStorage.getItem(sessionKey(playerFace)));
 	
 	let failureMessage;
-	switch (connectionResult.data) {
+	switch (result) {
 	case 'success':
+	case 'resumed':
 		failureMessage = null;
 		break;
 	case 'in_use':
 		failureMessage = 'That face is already in use. Please select a different one.';
 		break;
+	case 'invalid_face':
+		failureMessage = 'Faces can\'t have a # in them.';
+		break;
 	case 'invalid_world':
-		failureMessage = 'That, uh, world is invalid? This really shouldn\'t be showing up.';
+		failureMessage = 'World names can only use letters, numbers, - and _, up to 32 of them. The server may also be full.';
+		break;
+	case 'invalid_codec':
+		failureMessage = `The server doesn't support the '${codec}' protocol.`;
+		break;
+	case 'busy':
+		failureMessage = 'Too many people are joining right now. Please try again in a moment.';
 		break;
 	default:
-		failureMessage = `Unknown error occurred while joining: ${connectionResult.data}`;
+		failureMessage = `Unknown error occurred while joining: ${result}`;
 	}
 	
 	if (failureMessage) {
 		alert(failureMessage);
 		faceInput.disabled = false;
 		connectButton.disabled = false;
-	} else {
-		connectForm.remove();
+		return;
 	}
+	connectForm.remove();
+	sessionStorage.setItem(sessionKey(playerFace), session);
 	
 	const entityTypes = new EntityTypeRegistry(playerFace)
 		.register(Ant)
@@ -67,15 +115,18 @@ async function runGame() {
 	const engine = window.engine = new Engine(
 		document.getElementById('main-canvas'),
 		socket,
-		entityTypes);
+		entityTypes,
+		packets);
 
 	const [bgTile] = await engine.loadImages(['ChatterTile'], 'img/', '.png');
 	engine.bgFill = engine.ctx.createPattern(bgTile, 'repeat');
 	
-	try {
-		await engine.run();
-	} catch (e) {
-		if (e.type === 'close') {
+	while (true) {
+		try {
+			await engine.run();
+		} catch (e) {
+			if (e.type !== 'close') break;
+			
 			engine.ctx.textAlign = 'center';
 			engine.ctx.textBaseline = 'middle';
 			
@@ -103,6 +154,16 @@ async function runGame() {
 			
 			await waitMillis(1000);
 			
+			// Try to pick up where we left off first
+			const reconnected = await reconnect(engine, playerFace, session);
+			if (reconnected) {
+				engine.socket = reconnected.socket;
+				// A new one if the old session had expired
+				session = reconnected.session;
+				sessionStorage.setItem(sessionKey(playerFace), session);
+				continue;
+			}
+			
 			// Wait for server to come back online
 			while (true) {
 				try {
@@ -116,6 +177,27 @@ async function runGame() {
 					// Do nothing
 				}
 			}
+			return;
+		}
+	}
+}
+
+// Tries the session a few times while the connection is down. Resolves to
+// the new socket and session, or null if the server won't have us back.
+async function reconnect(engine, face, session) {
+	for (let tries = 0; tries < 5; tries++) {
+		try {
+			const reconnected = await connect(face, session, engine.updatesReceived);
+			if (reconnected.result === 'success' || reconnected.result === 'resumed') {
+				return reconnected;
+			}
+			if (reconnected.result !== 'busy') {
+				return null;
+			}
+		} catch (e) {
+			// Not back yet
 		}
+		await waitMillis(1000);
 	}
+	return null;
 }
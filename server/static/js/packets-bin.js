@@ -0,0 +1,326 @@
+
+// Compact binary counterpart to packets-json.js. Must be kept in
+// sync with server/packets_bin.py.
+
+const NONE     = 0;
+const FALSE    = 1;
+const TRUE     = 2;
+const INT      = 3;
+const FLOAT    = 4;
+const STR      = 5;
+const LIST     = 6;
+const MAP      = 7;
+const VEC2     = 8;
+const ENTITIES = 9;
+
+const KEYS = [
+	'type',
+	'pos',
+	'rot',
+	'text',
+	'scale',
+	'speech',
+	'gut',
+	'textActs',
+	'bellType',
+	'char',
+	'id',
+	'entities',
+];
+
+const keyIndices = new Map(KEYS.map((key, i) => [key, i]));
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+// Entity IDs by handle, learned from full snapshots
+const handleIDs = new Map();
+
+class Writer {
+	constructor() {
+		this.buffer = new ArrayBuffer(64);
+		this.view = new DataView(this.buffer);
+		this.bytes = new Uint8Array(this.buffer);
+		this.length = 0;
+	}
+	
+	reserve(n) {
+		if (this.length + n <= this.buffer.byteLength) return;
+		
+		let size = this.buffer.byteLength * 2;
+		while (size < this.length + n) size *= 2;
+		
+		const buffer = new ArrayBuffer(size);
+		new Uint8Array(buffer).set(this.bytes.subarray(0, this.length));
+		this.buffer = buffer;
+		this.view = new DataView(buffer);
+		this.bytes = new Uint8Array(buffer);
+	}
+	
+	byte(b) {
+		this.reserve(1);
+		this.bytes[this.length++] = b;
+	}
+	
+	varint(n) {
+		// Avoid bitwise ops, which truncate to 32 bits
+		while (n > 0x7f) {
+			this.byte((n % 0x80) | 0x80);
+			n = Math.floor(n / 0x80);
+		}
+		this.byte(n);
+	}
+	
+	float32(f) {
+		this.reserve(4);
+		this.view.setFloat32(this.length, f, true);
+		this.length += 4;
+	}
+	
+	raw(bytes) {
+		this.reserve(bytes.length);
+		this.bytes.set(bytes, this.length);
+		this.length += bytes.length;
+	}
+	
+	str(s) {
+		const encoded = textEncoder.encode(s);
+		this.varint(encoded.length);
+		this.raw(encoded);
+	}
+	
+	key(key) {
+		const index = keyIndices.get(key);
+		if (index === undefined) {
+			const encoded = textEncoder.encode(key);
+			this.varint(KEYS.length + encoded.length);
+			this.raw(encoded);
+		} else {
+			this.varint(index);
+		}
+	}
+	
+	value(v) {
+		if (v === null || v === undefined) {
+			this.byte(NONE);
+		} else if (v === false) {
+			this.byte(FALSE);
+		} else if (v === true) {
+			this.byte(TRUE);
+		} else if (typeof v === 'number') {
+			if (Number.isInteger(v)) {
+				this.byte(INT);
+				this.varint(v >= 0 ? v * 2 : -v * 2 - 1);
+			} else {
+				this.byte(FLOAT);
+				this.float32(v);
+			}
+		} else if (typeof v === 'string') {
+			this.byte(STR);
+			this.str(v);
+		} else if (typeof v.toJSON === 'function') {
+			this.value(v.toJSON());
+		} else if (Array.isArray(v)) {
+			if (v.length === 2
+				&& typeof v[0] === 'number'
+				&& typeof v[1] === 'number') {
+				
+				this.byte(VEC2);
+				this.float32(v[0]);
+				this.float32(v[1]);
+			} else {
+				this.byte(LIST);
+				this.varint(v.length);
+				for (const item of v) {
+					this.value(item);
+				}
+			}
+		} else {
+			// Skip undefined, like JSON.stringify
+			const entries = Object.entries(v)
+				.filter(([, item]) => item !== undefined);
+			
+			this.byte(MAP);
+			this.varint(entries.length);
+			for (const [key, item] of entries) {
+				this.key(key);
+				this.value(item);
+			}
+		}
+	}
+	
+	result() {
+		return this.buffer.slice(0, this.length);
+	}
+}
+
+class Reader {
+	constructor(buffer) {
+		this.view = new DataView(buffer);
+		this.bytes = new Uint8Array(buffer);
+		this.pos = 0;
+	}
+	
+	byte() {
+		return this.bytes[this.pos++];
+	}
+	
+	varint() {
+		let n = 0;
+		let mul = 1;
+		let b;
+		do {
+			b = this.byte();
+			n += (b & 0x7f) * mul;
+			mul *= 0x80;
+		} while (b & 0x80);
+		return n;
+	}
+	
+	float32() {
+		const f = this.view.getFloat32(this.pos, true);
+		this.pos += 4;
+		return f;
+	}
+	
+	str() {
+		return this.utf8(this.varint());
+	}
+	
+	utf8(length) {
+		const s = textDecoder.decode(
+			this.bytes.subarray(this.pos, this.pos + length));
+		this.pos += length;
+		return s;
+	}
+	
+	key() {
+		const n = this.varint();
+		return n < KEYS.length
+			? KEYS[n]
+			: this.utf8(n - KEYS.length);
+	}
+	
+	value() {
+		const tag = this.byte();
+		
+		switch (tag) {
+		case NONE:
+			return null;
+		case FALSE:
+			return false;
+		case TRUE:
+			return true;
+		case INT: {
+			const n = this.varint();
+			return (n % 2) ? -(n + 1) / 2 : n / 2;
+		}
+		case FLOAT:
+			return this.float32();
+		case STR:
+			return this.str();
+		case VEC2:
+			return [this.float32(), this.float32()];
+		case LIST: {
+			const items = [];
+			for (let i = this.varint(); i > 0; i--) {
+				items.push(this.value());
+			}
+			return items;
+		}
+		case MAP: {
+			const items = {};
+			for (let i = this.varint(); i > 0; i--) {
+				const key = this.key();
+				items[key] = this.value();
+			}
+			return items;
+		}
+		case ENTITIES: {
+			const entities = {};
+			for (let i = this.varint(); i > 0; i--) {
+				const head = this.varint();
+				const handle = Math.floor(head / 2);
+				
+				if (head % 2) {
+					handleIDs.set(handle, this.str());
+				}
+				
+				const id = handleIDs.get(handle);
+				if (id === undefined) {
+					throw new Error(`Unknown entity handle ${handle}`);
+				}
+				const value = this.value();
+				// Removed entities' handles are never used again
+				if (value === null) {
+					handleIDs.delete(handle);
+				}
+				entities[id] = value;
+			}
+			return entities;
+		}
+		default:
+			throw new Error(`Invalid value tag ${tag}`);
+		}
+	}
+}
+
+class PacketType {
+	constructor(name, index) {
+		this.name = name;
+		this.index = index;
+	}
+	
+	unparse(values) {
+		const writer = new Writer();
+		writer.varint(this.index);
+		writer.value(values);
+		return writer.result();
+	}
+	
+	toJSON() {
+		return this.name;
+	}
+}
+
+const packetList = [];
+
+export default class Packets {
+	constructor() {
+		throw new Error('Packets is a static class');
+	}
+	
+	static parse(buffer) {
+		const reader = new Reader(buffer);
+		
+		const index = reader.varint();
+		const type = packetList[index];
+		if (!type) {
+			throw new Error(`Invalid packet type ${index}`);
+		}
+		
+		// Handles are only valid within one world
+		if (type === Packets.S_OpenWorld || type === Packets.S_CloseWorld) {
+			handleIDs.clear();
+		}
+		
+		const data = reader.value();
+		data._type = type;
+		return data;
+	}
+};
+
+// Same order as the server's packet names
+for (let name of [
+	'S_OpenWorld',
+	'S_CloseWorld',
+	'S_UpdateWorld',
+	'C_UpdateSelf',
+	'C_MakeBox',
+	'C_MakePlant',
+	'C_Destroy',
+]) {
+	const packet = new PacketType(name, packetList.length);
+	packetList.push(packet);
+	Packets[name] = packet;
+}
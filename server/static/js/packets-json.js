@@ -1,6 +1,6 @@
 
-// Just using JSON for now. Much simpler than a more
-// efficient and complex data scheme.
+// Human-readable protocol, handy for debugging. See
+// packets-bin.js for the compact one used by default.
 
 class PacketType {
 	constructor(name) {
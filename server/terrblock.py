@@ -1,11 +1,16 @@
 from server.entity import Point, EntityBase, dataprop
 
 class TerrBlock(EntityBase):
+    __slots__ = ()
     type_id = 'terrblock'
 
     def __init__(self, pos, scale, angle=0):
-        super().__init__(pos, angle)
+        super().__init__(pos, angle, static=True)
 
         self.scale = scale
     
     scale = dataprop('scale')
+
+    def get_obb(self):
+        w, h = self.scale
+        return (self.pos, self.rot, w / 2, h / 2)
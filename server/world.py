@@ -1,105 +1,548 @@
 import asyncio
+import math
+import os
+import re
+import secrets
+import time
+from collections import deque
 from contextlib import asynccontextmanager
-from server.entity import Point
+from server.entity import Point, rotated_aabb
 from server.ant import Ant
 from server.plant import Plant
 from server.terrblock import TerrBlock
-import server.packets_json as packets
+from server.spatial import (SpatialGrid, aabb_intersects, aabb_sqr_distance,
+	obb_intersects, radius_aabb)
+from server.replication import MovementReplicator
+from server.scheduler import TickScheduler
+from server.growth import PlantGrowth
+from server.sharding import RemoteWorld, Worker
+from server.persistence import WorldStore, entity_links
+from server.journal import Journal
+from server.metrics import metrics
 from rtree import index as rtree
 import random
-from server.markov import MarkovSource
+from server import markov
 
 class ChatterUniverse:
-	def __init__(self):
+	# World ids clients may ask for
+	world_id_pattern = re.compile(r'[A-Za-z0-9_-]{1,32}')
+	# Most worlds loaded at once. Past this, the world that has been
+	# hibernating longest is unloaded to make room.
+	max_worlds = 1000
+	# Seconds a world can be empty before it stops ticking
+	hibernate_after = 60
+	# Entities kept loaded across all worlds. Past this, the worlds that have
+	# been hibernating longest are saved and unloaded, when saving is enabled.
+	max_loaded_entities = 200000
+	# Seconds a disconnected client's ant is kept, for it to resume its
+	# session. 0 to remove clients as soon as they disconnect.
+	resume_window = 30
+	# Clients that may be waiting to be let into a world at once, and the
+	# seconds they wait before being turned away
+	max_joining = 500
+	join_timeout = 10
+	
+	def __init__(self, default_world=True):
 		self.worlds = {}
 		self.clients = {}
-		self.add_world(ChatterWorld('default'))
+		# Clients by session token
+		self.sessions = {}
+		self.joining = 0
+		# Unloaded worlds by id, until they're saved
+		self.unloading = {}
+		self.workers = []
+		self.scheduler = TickScheduler()
+		self.store = None
+		self.journal = None
+		# Called with each world unloaded, once it's saved if saving is enabled
+		self.on_unloaded = None
+		if default_world:
+			self.add_world(ChatterWorld('default'))
 	
 	async def run(self):
-		while True:
-			await asyncio.sleep(1 / 30)
-			for world in self.worlds.values():
-				try:
-					world.broadcast_tick()
-				except Exception as e:
-					print('Exception while ticking world', world.id)
-					print(e)
+		loop = asyncio.get_running_loop()
+		for worker in self.workers:
+			loop.add_reader(worker.conn.fileno(), self.on_worker_message, worker)
+		for world in self.worlds.values():
+			if not isinstance(world, RemoteWorld):
+				markov.preload(world.corpus)
+		if self.store:
+			asyncio.ensure_future(self.store.run(self))
+		if self.journal:
+			asyncio.ensure_future(self.journal.run())
+		asyncio.ensure_future(self.hibernate_idle())
+		await self.scheduler.run()
+	
+	# Saves worlds to directory, restoring any saved there before. Worlds
+	# created later are restored by new_world.
+	def enable_saving(self, directory):
+		self.store = WorldStore(directory)
+		for world in self.worlds.values():
+			if not isinstance(world, RemoteWorld) and not world.clients:
+				self.store.restore(world)
+				world.record_opened()
+	
+	def enable_journal(self, directory):
+		self.journal = Journal(directory)
+		for world in self.local_worlds():
+			world.record_opened()
+	
+	# Collects tick timings and packet counts for the /metrics routes
+	def enable_metrics(self):
+		metrics.enabled = True
+	
+	# Saves everything, before the server stops
+	async def close(self):
+		if self.workers:
+			loop = asyncio.get_running_loop()
+			for worker in self.workers:
+				loop.remove_reader(worker.conn.fileno())
+			await asyncio.get_running_loop().run_in_executor(None, self.stop_workers)
+		if self.store:
+			await self.store.save_all(self)
+		if self.journal:
+			await self.journal.flush()
+	
+	def new_world(self, id, **kwargs):
+		world = ChatterWorld(id, **kwargs)
+		if self.store:
+			self.store.restore(world)
+		return world
 	
 	@property
 	def default(self):
-		return self.worlds['default']
+		return self.open_world('default')
+	
+	# Finds the world with this id, creating it (or loading it back from disk)
+	# if it isn't loaded and waking it if it's hibernating. Returns None if
+	# clients can't have it.
+	def open_world(self, world_id):
+		world = self.worlds.get(world_id)
+		if world is None:
+			if not self.world_id_pattern.fullmatch(world_id):
+				return None
+			if self.workers:
+				# Workers keep to max_worlds themselves, and report the worlds
+				# they unload to make room
+				self.add_world(world_id, self.next_worker())
+				return self.worlds[world_id]
+			if len(self.worlds) >= self.max_worlds and not self.unload_oldest():
+				return None
+			# Taken back as it is if it hasn't finished saving since unloading
+			world = self.unloading.pop(world_id, None)
+			if world is None:
+				world = self.new_world(world_id)
+			world.hibernating = False
+			self.add_world(world)
+		elif not isinstance(world, RemoteWorld) and world.hibernating:
+			self.wake(world)
+		return world
+	
+	# Returns whether there was a hibernating world to unload. It's saved
+	# after being unloaded, or lost if saving isn't enabled.
+	def unload_oldest(self):
+		hibernating = [w for w in self.local_worlds() if w.hibernating]
+		if not hibernating:
+			return False
+		world = min(hibernating, key=lambda w: w.hibernated_at)
+		self.remove_world(world)
+		if self.store:
+			self.unloading[world.id] = world
+			asyncio.ensure_future(self.save_unloaded(world))
+		elif self.on_unloaded:
+			self.on_unloaded(world)
+		return True
+	
+	async def save_unloaded(self, world):
+		try:
+			await self.store.save(world)
+		except Exception as e:
+			# Kept until it can be reopened, rather than lost
+			print('Could not save world', world.id, e)
+			return
+		if self.unloading.get(world.id) is world:
+			del self.unloading[world.id]
+			if self.on_unloaded:
+				self.on_unloaded(world)
+	
+	def local_worlds(self):
+		return [w for w in self.worlds.values() if not isinstance(w, RemoteWorld)]
+	
+	# Hibernating worlds stay loaded, but aren't ticked until someone joins
+	def hibernate(self, world):
+		self.scheduler.remove(world)
+		world.hibernating = True
+		world.hibernated_at = time.monotonic()
+	
+	def wake(self, world):
+		world.hibernating = False
+		self.scheduler.add(world)
+	
+	async def hibernate_idle(self, interval=5):
+		while True:
+			await asyncio.sleep(interval)
+			now = time.monotonic()
+			for world in self.local_worlds():
+				if (not world.hibernating and not world.clients and not world.joining
+						and now - world.idle_since > self.hibernate_after):
+					self.hibernate(world)
+			if self.store:
+				await self.evict()
+	
+	# Unloads the least recently used hibernating worlds until few enough
+	# entities are loaded. They're loaded back from disk when next opened.
+	async def evict(self):
+		loaded = sum(len(w.entities) for w in self.local_worlds())
+		hibernating = sorted(
+			(w for w in self.local_worlds() if w.hibernating),
+			key=lambda w: w.hibernated_at)
+		for world in hibernating:
+			if loaded <= self.max_loaded_entities:
+				break
+			try:
+				await self.store.save(world)
+			except Exception as e:
+				print('Could not save world', world.id, e)
+				continue
+			# Someone may have opened it while it was saving
+			if world.hibernating and self.remove_world(world):
+				loaded -= len(world.entities)
+				if self.on_unloaded:
+					self.on_unloaded(world)
+	
+	def start_workers(self, count):
+		save_dir = self.store.directory if self.store else None
+		journal_dir = os.path.dirname(self.journal.fileName) if self.journal else None
+		for i in range(count):
+			worker = Worker(len(self.workers), save_dir, journal_dir)
+			worker.start()
+			self.workers.append(worker)
+		
+		# Hand over any worlds nobody has joined yet
+		for world in list(self.worlds.values()):
+			if not isinstance(world, RemoteWorld) and not world.clients:
+				self.remove_world(world)
+				self.add_world(world.id, self.next_worker())
 	
-	def add_world(self, world):
+	def stop_workers(self):
+		for worker in self.workers:
+			worker.stop()
+		for worker in self.workers:
+			worker.join()
+		self.workers = []
+	
+	def on_worker_message(self, worker):
+		while worker.conn.poll():
+			command, *args = worker.conn.recv()
+			if command == 'unloaded':
+				self.forget_world(args[0], worker)
+	
+	# Stops routing a world to a worker that unloaded it. It's kept if anyone
+	# is connected, since the worker loads it again for them.
+	def forget_world(self, world_id, worker):
+		world = self.worlds.get(world_id)
+		if (isinstance(world, RemoteWorld) and world.worker is worker
+				and not world.connections):
+			del self.worlds[world_id]
+			world.universe = None
+			worker.worlds.discard(world_id)
+	
+	def next_worker(self):
+		return min(self.workers, key=lambda w: len(w.worlds), default=None)
+	
+	# With a worker, world is the id of a world for that worker to create
+	def add_world(self, world, worker=None):
+		if worker is not None:
+			world = RemoteWorld(world, worker)
+		
 		if self.worlds.setdefault(world.id, world) != world:
 			raise KeyError(f'{world.id} is already in use')
 		if world.universe:
 			raise ValueError('World is already part of a universe')
 		world.universe = self
+		
+		if worker is not None:
+			worker.create_world(world.id)
+		else:
+			self.scheduler.add(world)
+			world.record_opened()
 	
-	@asynccontextmanager
-	async def add_client(self, client, world=None):
-		if client.face in self.clients:
-			await client.send('in_use')
-			raise KeyError(f'{client.face} is already in use')
+	def remove_world(self, world):
+		if self.worlds.get(world.id) != world:
+			return False
+		if isinstance(world, RemoteWorld):
+			raise ValueError('Cannot remove a world hosted by a worker')
 		
+		for client in list(world.clients.values()):
+			world.remove_client(client)
+		del self.worlds[world.id]
+		self.scheduler.remove(world)
+		world.universe = None
+		metrics.forget_world(world.id)
+		return True
+	
+	# A client giving the session token it was given before, for the same
+	# face and world, takes back its ant. It's only sent the world again if
+	# it missed too many of the updates sent before it disconnected, with
+	# received being how many it got.
+	@asynccontextmanager
+	async def add_client(self, client, world=None, session=None, received=None):
 		world = world or self.default
 		
 		if self.worlds.get(world.id) != world:
 			await client.send('invalid_world')
 			raise ValueError('Asked to join unknown world')
 		
-		self.clients[client.face] = client
-		world.add_client(client)
+		if isinstance(world, RemoteWorld):
+			previous = self.clients.get(client.face)
+			if previous:
+				# Only the session's owner can take over, and the proxy learns
+				# the session from the worker's reply
+				if session is None or previous.session != session:
+					await client.send('in_use')
+					raise KeyError(f'{client.face} is already in use')
+				# The old connection hasn't noticed it's gone yet. The worker
+				# hands its ant over to this one.
+				asyncio.ensure_future(previous.ws.close())
+			self.clients[client.face] = client
+			world.connections += 1
+			# The owning worker does the rest of the handshake
+			try:
+				yield client
+			finally:
+				world.connections -= 1
+				# Unless a newer connection took over
+				if self.clients.get(client.face) is client:
+					del self.clients[client.face]
+			return
+		
+		start = time.perf_counter()
+		ws = client.ws
+		previous = self.sessions.get(session)
+		if previous and previous.face == client.face and previous.world is world:
+			packets = client.packets
+			client = previous
+			# What the client has was sent in the old codec, if it changed
+			if client.packets is not packets:
+				client.packets = packets
+				received = None
+			if client.suspended:
+				client.expiry.cancel()
+			else:
+				# The old connection hasn't noticed it's gone yet
+				asyncio.ensure_future(client.ws.close())
+				client.suspend()
+			resumed = client.resume(ws, received)
+		elif client.face in self.clients:
+			await client.send('in_use')
+			raise KeyError(f'{client.face} is already in use')
+		else:
+			previous = None
+			resumed = False
+			self.clients[client.face] = client
+		
+		if not resumed:
+			admitted = False
+			try:
+				admitted = await self.admit(client, world)
+			finally:
+				if not admitted:
+					if previous:
+						self.suspend(client)
+					else:
+						del self.clients[client.face]
+			if not admitted:
+				if metrics.enabled:
+					metrics.count_rejected('join', 'busy')
+				await client.send('busy')
+				raise RuntimeError('Too many clients joining')
 		
-		await client.send('success')
+		if metrics.enabled:
+			metrics.observe(world.id, 'resume' if resumed else 'join',
+				time.perf_counter() - start)
+		if client.session is None:
+			client.session = secrets.token_urlsafe(16)
+			self.sessions[client.session] = client
+		
+		await client.send(f'{"resumed" if resumed else "success"}:{client.session}')
+		client.start_writer()
 		
 		try:
 			yield client
 		finally:
+			# Unless a newer connection took over
+			if client.ws is ws:
+				if client.world and self.resume_window:
+					self.suspend(client)
+				else:
+					self.drop_client(client)
+	
+	# Waits for the world to let the client in. Returns whether it did.
+	async def admit(self, client, world):
+		if self.joining >= self.max_joining:
+			return False
+		self.joining += 1
+		try:
+			await asyncio.wait_for(world.admit(client), self.join_timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+		finally:
+			self.joining -= 1
+	
+	def suspend(self, client):
+		client.suspend()
+		client.expiry = asyncio.get_running_loop().call_later(
+			self.resume_window, self.drop_client, client)
+	
+	def drop_client(self, client):
+		if self.clients.get(client.face) is client:
 			del self.clients[client.face]
-			if client.world:
-				client.world.remove_client(client)
+		self.sessions.pop(client.session, None)
+		if client.expiry:
+			client.expiry.cancel()
+		if client.world:
+			client.world.remove_client(client)
+		client.stop_writer()
 	
-	def broadcast(self, packet, ignore=None):
+	def broadcast(self, name, ignore=None, **fields):
+		encoded = {}
 		for client in self.clients.values():
 			if client == ignore:
 				continue
-			asyncio.create_task(client.ws.send(packet))
+			packet = encoded.get(client.packets)
+			if packet is None:
+				packet = client.packets.types[name](**fields)
+				encoded[client.packets] = packet
+			client.queue_packet(packet, name)
 
 class ChatterWorld:
-	def __init__(self, id):
+	# Most entities of each type clients may make in a world
+	quotas = {'box': 1000, 'plant': 200}
+	# Clients let in per tick. Sending a client the world is costly, so when
+	# many join at once the rest wait their turn.
+	joins_per_tick = 4
+	
+	def __init__(self, id, tick_rate=30, corpus=markov.DEFAULT_CORPUS, growth_rate=0.25):
 		self.id = id
 		self.universe = None
+		self.tick_rate = tick_rate
+		# Ticks taking longer than this are counted as overruns
+		self.tick_budget = 0.5 / tick_rate
+		self.tick_duration = 0
+		self.tick_overruns = 0
+		self.skipped_ticks = 0
+		self.tick_errors = 0
 		self.entities = {}
+		self.type_counts = {}
+		# Entities with properties changed this tick
+		self.dirty_entities = []
+		# Changes since the world was last saved
+		self.unsaved = set()
+		self.unsaved_removed = set()
 		self.plants = []
+		# Branch attempts per plant per second
+		self.growth = PlantGrowth(growth_rate)
 		self.clients = {}
-		self.dynamic_rtree = None
+		# Clients waiting to be let in, with futures resolved once they are
+		self.joining = deque()
+		# When the last client left, and whether the world has stopped ticking
+		# since
+		self.idle_since = time.monotonic()
+		self.hibernating = False
+		self.hibernated_at = None
+		self.next_handle = 0
+		self.tick = 0
+		self.movement = MovementReplicator()
+		self.dynamic_grid = SpatialGrid()
 		self.static_rtree = rtree.Index()
-		self.markov = MarkovSource()
-		self.markov.load("server/sourcetext/AliceInWonderland.txt")
+		self.static_entities = {}
+		self.corpus = corpus
+		markov.preload(corpus)
 		self.add_terrain()
 	
-	def add_client(self, client):
+	def record(self, event, face=None, fields=None):
+		if self.universe and self.universe.journal:
+			self.universe.journal.record(self, event, face, fields)
+	
+	# Stands in with a fallback until the corpus has loaded
+	@property
+	def markov(self):
+		return markov.corpus_or_fallback(self.corpus)
+	
+	# A handle is only given when replaying a client that was already here
+	def add_client(self, client, handle=None):
 		if (client.world):
 			client.world.remove_client(client)
 		
+		# Added first, as it fails without changing anything if its id is taken
+		entity = Ant(client, Point(100, 100), 0)
+		self.add_entity(entity, handle)
+		
 		self.clients[client.face] = client
+		self.idle_since = None
 		client.world = self
-		client.entity = Ant(client, Point(100, 100), 0)
-		self.add_entity(client.entity)
+		client.entity = entity
+		self.record('join', client.face)
+		self.open(client)
+	
+	# Sends the client what it can see, as though it had just joined
+	def open(self, client):
+		client.reset_sent()
+		self.update_view(client)
+		client.stale.clear()
+		moving = client.visible_moving = set(self.dynamic_grid.query(client.view))
 		
-		# TODO: Limit to nearby entities
-		asyncio.create_task(client.send(packets.S_OpenWorld(entities={
-			i: e.data for i, e in self.entities.items()
-		})))
+		# Only the nearest entities are sent straight away; the rest follow in
+		# the next ticks' updates
+		cache = client.packets.FragmentCache()
+		entries = []
+		updated = set()
+		moved = {}
+		self.send_full(client, cache, [*client.visible, *moving],
+			entries, updated, moved)
+		# Unlike world updates, this is never dropped, so counts as received
+		client.acknowledge(self.tick, updated, (), moved)
+		client.queue_packet(
+			client.packets.S_OpenWorld.splice(entities=entries), 'S_OpenWorld')
+	
+	# Resolves once the client is in the world, or has been sent it again if
+	# it was already
+	def admit(self, client):
+		future = asyncio.get_running_loop().create_future()
+		self.joining.append((client, future))
+		return future
+	
+	def admit_joining(self):
+		admitted = 0
+		while self.joining and admitted < self.joins_per_tick:
+			client, future = self.joining.popleft()
+			# It gave up waiting
+			if future.done():
+				continue
+			if client.world is self:
+				client.suspended = False
+				self.open(client)
+			else:
+				try:
+					self.add_client(client)
+				except KeyError as e:
+					# Turned away, without holding up the others
+					future.set_exception(e)
+					continue
+			future.set_result(None)
+			admitted += 1
 	
 	def remove_client(self, client):
 		result = False
 		
 		if self.clients.get(client.face) == client:
+			self.record('leave', client.face)
 			del self.clients[client.face]
+			if not self.clients:
+				self.idle_since = time.monotonic()
 			client.world = None
-			asyncio.create_task(client.send(packets.S_CloseWorld()))
+			client.queue_packet(client.packets.S_CloseWorld(), 'S_CloseWorld')
 			result = True
 		
 		if client.entity and self.remove_entity(client.entity):
@@ -108,66 +551,323 @@ class ChatterWorld:
 		
 		return result
 	
-	def add_entity(self, entity):
+	# A handle is only given when restoring a saved entity
+	def add_entity(self, entity, handle=None):
+		if handle is None:
+			handle = self.next_handle
+		if entity.id is None:
+			entity.id = f'#{handle:05x}'
 		if self.entities.setdefault(entity.id, entity) != entity:
 			raise KeyError(f'{entity.id} is already in use')
 		entity.world = self
+		entity.handle = handle
+		entity.version = self.tick
+		type_id = entity.data['type']
+		self.type_counts[type_id] = self.type_counts.get(type_id, 0) + 1
+		self.next_handle = max(self.next_handle, handle + 1)
+		# New entities are sent in full
+		entity.clear_diff()
+		if entity.is_static:
+			self.static_entities[handle] = entity
+			# Static entities never move, so this is their box for good
+			entity.aabb = entity.get_aabb()
+			self.static_rtree.insert(handle, entity.aabb)
+			for client in self.clients.values():
+				if client.view is not None and aabb_intersects(entity.aabb, client.view):
+					client.visible.add(entity)
+					client.stale.add(entity)
+		else:
+			self.dynamic_grid.insert(entity)
 		if isinstance(entity, Plant):
 			self.plants.append(entity)
+		if entity.is_static:
+			self.unsaved.add(entity)
+	
+	# Growth is random, so what grew is journaled for replays
+	def add_word(self, word):
+		self.add_entity(word)
+		self.record('grow', None, {
+			'handle': word.handle,
+			'data': dict(word.data),
+			'links': entity_links(word),
+		})
+	
+	# Terrain is random and saved worlds come from disk, so what a world
+	# starts out with is journaled for replays too
+	def record_opened(self):
+		self.record('opened', None, {
+			'entities': [
+				[e.handle, dict(e.data), entity_links(e)]
+				for e in self.static_entities.values()
+			],
+			'next_handle': self.next_handle,
+		})
 	
 	def remove_entity(self, entity):
 		if self.entities.get(entity.id) != entity:
 			return False
 		else:
 			del self.entities[entity.id]
+			self.type_counts[entity.data['type']] -= 1
+			if entity.is_static:
+				del self.static_entities[entity.handle]
+				self.static_rtree.delete(entity.handle, entity.aabb)
+				for client in self.clients.values():
+					if entity in client.visible:
+						client.visible.remove(entity)
+						client.stale.add(entity)
+			else:
+				self.dynamic_grid.remove(entity)
+				for client in self.clients.values():
+					client.sent_movement.pop(entity, None)
+			if isinstance(entity, Plant):
+				self.plants.remove(entity)
+			if entity.is_static:
+				self.unsaved.discard(entity)
+				self.unsaved_removed.add(entity.handle)
 			entity.on_removed()
 			return True
 	
-	def broadcast(self, packet, ignore=None):
+	def has_room(self, type_id):
+		quota = self.quotas.get(type_id)
+		return quota is None or self.type_counts.get(type_id, 0) < quota
+	
+	def query_rect(self, aabb):
+		for handle in self.static_rtree.intersection(aabb):
+			yield self.static_entities[handle]
+		yield from self.dynamic_grid.query(aabb)
+	
+	# Whether an oriented box would overlap any static entity
+	def obstructed(self, obb, ignore=()):
+		for handle in self.static_rtree.intersection(rotated_aabb(*obb)):
+			entity = self.static_entities[handle]
+			if entity not in ignore and obb_intersects(obb, entity.get_obb()):
+				return True
+		return False
+	
+	def query_radius(self, center, radius):
+		sqr_radius = radius * radius
+		for entity in self.query_rect(radius_aabb(center, radius)):
+			if aabb_sqr_distance(entity.aabb, center) <= sqr_radius:
+				yield entity
+	
+	def broadcast(self, name, ignore=None, **fields):
+		encoded = {}
 		for client in self.clients.values():
 			if client == ignore:
 				continue
-			asyncio.create_task(client.send(packet))
+			packet = encoded.get(client.packets)
+			if packet is None:
+				packet = client.packets.types[name](**fields)
+				encoded[client.packets] = packet
+			client.queue_packet(packet, name)
+	
+	# Works out what the client can see again, if its ant has moved into
+	# another cell since. The view covers all a client's view_radius could
+	# reach from anywhere in the cell, so it only has to change with the cell,
+	# and what came into or went out of view is marked stale.
+	def update_view(self, client):
+		step = client.view_step
+		x, y = client.entity.pos
+		cell = (math.floor(x / step), math.floor(y / step))
+		if cell == client.view_cell:
+			return
+		
+		client.view_cell = cell
+		radius = client.view_radius
+		cx, cy = cell
+		client.view = (
+			cx * step - radius, cy * step - radius,
+			(cx + 1) * step + radius, (cy + 1) * step + radius)
+		visible = {
+			self.static_entities[handle]
+			for handle in self.static_rtree.intersection(client.view)
+		}
+		client.stale |= visible ^ client.visible
+		client.visible = visible
+	
+	# Sends entities in full. A client catching up after joining is only sent
+	# the nearest of them that fit in its join_batch_bytes, and is ready
+	# once they all fit.
+	def send_full(self, client, cache, entities, entries, updated, moved):
+		limit = None
+		if not client.ready:
+			limit = client.join_batch_bytes
+			center = client.entity.pos
+			entities.sort(key=lambda e: aabb_sqr_distance(e.aabb, center))
+		
+		size = 0
+		for i, entity in enumerate(entities):
+			entry = cache.entry(entity, 'data', entity.data)
+			if limit is not None:
+				size += len(entry)
+				# Always send at least one, however big
+				if size > limit and i > 0:
+					client.stale.update(entities[i:])
+					return
+			entries.append(entry)
+			updated.add(entity)
+			if not entity.is_static:
+				self.movement.sent_full(entity, moved)
+		client.ready = True
 	
 	def broadcast_tick(self):
+		timed = metrics.enabled
+		if timed:
+			start = time.perf_counter()
+			serialize_time = 0
+		
+		if self.joining:
+			self.admit_joining()
+		self.tick += 1
 		self._tick()
+		for entity in self.dirty_entities:
+			# Only entities that changed can have moved
+			if not entity.is_static and entity.world is self:
+				self.dynamic_grid.update(entity)
+			entity.sync_data()
+		if timed:
+			metrics.observe(self.id, 'logic', time.perf_counter() - start)
+			start = time.perf_counter()
 		
-		# Assert: every entity's temp_seen_by is empty
+		# Entities are encoded once per tick per codec and shared between clients
+		caches = {}
+		# Diffs are built from the dirty flags once per tick
+		diffs = {}
+		# Diffs of moving entities, minus the movement replicated per client
+		still_diffs = {}
+		
+		def diff_of(entity):
+			if not entity.dirty:
+				return {}
+			diff = diffs.get(entity)
+			if diff is None:
+				diff = diffs[entity] = entity.diff
+			return diff
+		
+		dirty_static = [e for e in self.dirty_entities if e.is_static]
+		self.movement.start_tick()
 		
 		for client in self.clients.values():
+			if client.suspended:
+				continue
+			cache = caches.get(client.packets)
+			if cache is None:
+				cache = caches[client.packets] = client.packets.FragmentCache()
+			
+			# If the client is lagging, its unsent update is replaced by this one
+			client.drop_pending_updates()
+			self.update_view(client)
+			
+			# Only what changed since the last update the client received is
+			# sent: diffs of entities it's up to date with, entities it doesn't
+			# have (or missed changes to) in full, and nulls for entities it
+			# should remove. Static entities are only looked at if they changed
+			# or are stale; the rest haven't changed since the client had them.
+			entries = []
+			updated = set()
+			moved = {}
+			unsent = []
+			removed = set()
+			sent = client.sent
+			visible = client.visible
+			moving = set(self.dynamic_grid.query(client.view))
 			
-			entity_diffs = {}
-			# TODO: Limit to nearby entities
-			for entity in self.entities.values():
-				if client in entity.seen_by:
-					# Don't send self-diffs, unless correcting
-					if entity == client.entity:
-						if entity.correcting:
-							entity_diffs[entity.id] = entity.diff
-							correcting = False
-						else:
-							entity_diffs[entity.id] = {}
+			if client.stale:
+				stale, client.stale = client.stale, set()
+				for entity in stale:
+					if entity in visible:
+						# Changed ones are seen to below
+						if not entity.dirty:
+							received = sent.get(entity)
+							if received is None or received < entity.version:
+								unsent.append(entity)
+					elif entity not in moving and entity in sent:
+						removed.add(entity)
+			for entity in client.visible_moving:
+				if entity not in moving and entity in sent:
+					removed.add(entity)
+			client.visible_moving = moving
+			
+			for entity in dirty_static:
+				if entity in visible:
+					received = sent.get(entity)
+					if received is not None and received >= entity.version:
+						entries.append(cache.entry(entity, 'diff', diff_of(entity)))
+						updated.add(entity)
 					else:
-						entity_diffs[entity.id] = entity.diff
+						unsent.append(entity)
+			
+			for entity in moving:
+				received = sent.get(entity)
+				if entity == client.entity and received is not None:
+					# Don't send self-diffs, unless correcting, even if the client
+					# missed some; it made them itself. Only the position is
+					# corrected; the client already has the rest.
+					if entity.correcting:
+						entries.append(cache.entry(entity, 'correction', {
+							'pos': entity.data['pos'],
+							'rot': entity.data['rot'],
+						}))
+						entity.correcting = False
+					updated.add(entity)
+				elif received is None or received < entity.version:
+					unsent.append(entity)
 				else:
-					entity_diffs[entity.id] = entity.data
-				entity.temp_seen_by.add(client)
+					still = still_diffs.get(entity)
+					if still is None:
+						still = still_diffs[entity] = {
+							k: v for k, v in diff_of(entity).items()
+							if k != 'pos' and k != 'rot'
+						}
+					
+					# Stopped entities are still checked, so they settle
+					movement = self.movement.update(client, entity, self.tick, moved)
+					if movement:
+						kind = ('moved', movement.get('pos'), movement.get('rot'))
+						entries.append(cache.entry(entity, kind, {**still, **movement}))
+					elif still:
+						entries.append(cache.entry(entity, 'still', still))
+					updated.add(entity)
+			if unsent:
+				self.send_full(client, cache, unsent, entries, updated, moved)
 			
-			asyncio.create_task(client.send(packets.S_UpdateWorld(
-				entities=entity_diffs)))
-		
-		for entity in self.entities.values():
-			# Swap seen_by and temp_seen_by, clear the new temp
-			(
-				entity.seen_by,
-				entity.temp_seen_by
-			) = (
-				entity.temp_seen_by,
-				entity.seen_by
-			)
-			entity.temp_seen_by.clear()
+			# Removals go first, in case an entity with the same id replaced one
+			if removed:
+				entries = [cache.entry(e, 'removed', None) for e in removed] + entries
+			if not entries:
+				# Nothing the client has changed, so it's as up to date as if it
+				# had been sent an update. Its unsent updates were dropped above,
+				# so none can be acknowledged after this.
+				client.acknowledge(self.tick, updated, removed, moved)
+				continue
 			
-			entity.diff.clear()
+			if timed:
+				splice_start = time.perf_counter()
+				packet = client.packets.S_UpdateWorld.splice(entities=entries)
+				serialize_time += time.perf_counter() - splice_start
+			else:
+				packet = client.packets.S_UpdateWorld.splice(entities=entries)
+			client.queue_update(packet, (self.tick, updated, removed, moved))
+		
+		if timed:
+			metrics.observe(self.id, 'diff', time.perf_counter() - start - serialize_time)
+			metrics.observe(self.id, 'serialize', serialize_time)
+		
+		journal = self.universe and self.universe.journal
+		for entity in self.dirty_entities:
+			if entity.is_static:
+				self.unsaved.add(entity)
+				# Clients' own changes are journaled as packets; this catches
+				# the world's, like a plant giving its text to its first word
+				if journal:
+					journal.record(self, 'changed', None, {
+						'handle': entity.handle,
+						'diff': entity.diff,
+					})
+			entity.version = self.tick
+			entity.clear_diff()
+		self.dirty_entities.clear()
 	
 	def add_terrain(self):
 		for i in range(0, 10):
@@ -176,6 +876,4 @@ class ChatterWorld:
 			self.add_entity(t)
 	
 	def _tick(self):
-		# Plants
-		if len(self.plants) > 0 and random.random() > 0.96:
-			random.choice(self.plants).branch()
+		self.growth.step(self)